@@ -0,0 +1,134 @@
+import base64
+import codecs
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional
+from app.cache import ResultCache
+from app.github_client import AsyncGitHub
+from app.local_git import LocalGit
+from app.logger import setup_logger
+
+logger = setup_logger("blobs")
+
+
+def decode_file_content(encoded: str, max_bytes: int) -> str:
+    """Decode base64 file contents, stopping after `max_bytes` bytes of UTF-8 text."""
+    needed = (max_bytes // 3 + 1) * 4
+    # GitHub wraps base64 contents every 60 characters, so twice the needed length covers the line breaks
+    encoded = "".join(encoded[:needed * 2].split())[:needed]
+    data = base64.b64decode(encoded[:len(encoded) - len(encoded) % 4])[:max_bytes]
+    # a multi-byte character cut at the limit is dropped, anything else invalid is an error
+    return codecs.getincrementaldecoder("utf-8")().decode(data, final=False)
+
+
+def truncate_file_content(content: str, max_bytes: int) -> str:
+    if len(content) <= max_bytes // 4:
+        return content
+    return content.encode("utf-8")[:max_bytes].decode("utf-8", errors="ignore")
+
+
+class BlobStore:
+    """File contents addressed by git blob SHA.
+
+    The tree of a commit maps each path to the SHA of its blob, and a blob never changes once written, so its
+    text is cached on disk without invalidation. Files unchanged between two pushes share a blob and are only
+    downloaded once, by whichever run saw them first. Point `directory` at the actions/cache directory.
+
+    Without a local clone, the blob of a path is found one directory at a time, from the root of the commit down
+    to the parent of the file, instead of listing the recursive tree of the whole repository. Directories are
+    listed once per run, and cached on disk by tree SHA like blobs.
+    """
+
+    def __init__(self, github: AsyncGitHub, directory: str = "", local: Optional[LocalGit] = None):
+        self.github = github
+        self.local = local
+        self.cache = ResultCache(directory, "blobs")
+        self.tree_cache = ResultCache(directory, "trees")
+        self.local_trees: Dict[str, asyncio.Future] = {}
+        self.directories: Dict[str, asyncio.Future] = {}
+
+    @staticmethod
+    async def _memoized(cache: Dict[Any, asyncio.Future], key: Any, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        if key not in cache:
+            cache[key] = asyncio.ensure_future(fetch())
+        try:
+            return await cache[key]
+        except Exception:
+            cache.pop(key, None)
+            raise
+
+    async def get_directory(self, sha: str) -> Optional[Dict[str, Dict[str, str]]]:
+        """Blob and subtree SHAs by name of one directory, given its tree SHA or, for the root, a commit SHA.
+        None when GitHub truncated the listing."""
+        return await self._memoized(self.directories, sha, lambda: self._fetch_directory(sha))
+
+    async def _fetch_directory(self, sha: str) -> Optional[Dict[str, Dict[str, str]]]:
+        key = ResultCache.key(sha)
+        directory = self.tree_cache.get(key)
+        if directory is not None:
+            return directory
+
+        tree = await self.github.run(self.github.repo.get_git_tree, sha)
+        if tree.raw_data.get("truncated"):
+            logger.info(f"tree {sha} is truncated, file contents are fetched by path")
+            return None
+        directory = {
+            "blobs": {element.path: element.sha for element in tree.tree if element.type == "blob"},
+            "trees": {element.path: element.sha for element in tree.tree if element.type == "tree"},
+        }
+        # the root is requested by commit SHA, only listings requested by their own tree SHA are stored under it
+        if tree.sha == sha:
+            self.tree_cache.set(key, directory)
+        return directory
+
+    async def get_blob_sha(self, ref: str, path: str) -> Optional[str]:
+        """SHA of the blob of `path` at commit `ref`: "" when there is no such file, None when the tree cannot
+        tell."""
+        if self.local:
+            tree = await self._memoized(self.local_trees, ref, lambda: self.local.get_tree(ref))
+            if tree is not None:
+                return tree.get(path, "")
+
+        *parents, name = path.split("/")
+        sha = ref
+        for parent in parents:
+            directory = await self.get_directory(sha)
+            if directory is None:
+                return None
+            if parent not in directory["trees"]:
+                return ""
+            sha = directory["trees"][parent]
+
+        directory = await self.get_directory(sha)
+        if directory is None:
+            return None
+        return directory["blobs"].get(name, "")
+
+    async def get_text(self, sha: str, max_bytes: int) -> str:
+        """Text of the blob cut to `max_bytes` bytes, "" for binary files."""
+        key = ResultCache.key(sha, str(max_bytes))
+        text = self.cache.get(key)
+        if text is not None:
+            return text
+
+        data = await self.local.read_blob(sha) if self.local else None
+        try:
+            if data is not None:
+                text = codecs.getincrementaldecoder("utf-8")().decode(data[:max_bytes], final=False)
+            else:
+                blob = await self.github.run(self.github.repo.get_git_blob, sha)
+                text = decode_file_content(blob.content, max_bytes) if blob.encoding == "base64" else \
+                    truncate_file_content(blob.content, max_bytes)
+        except UnicodeDecodeError:
+            text = ""
+        self.cache.set(key, text)
+        return text
+
+    async def get_file(self, ref: str, path: str, max_bytes: int) -> Optional[str]:
+        """Text of the file at `ref`: "" when it does not exist there, None when the tree cannot tell."""
+        sha = await self.get_blob_sha(ref, path)
+        if not sha:
+            return sha
+        return await self.get_text(sha, max_bytes)
+
+    def stats(self) -> str:
+        return self.cache.stats()
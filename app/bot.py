@@ -1,7 +1,15 @@
 import os
 import time
-from datetime import datetime
-from tenacity import retry, stop_after_attempt, wait_fixed
+import heapq
+import asyncio
+import itertools
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+import httpx
+import openai
+import requests
+from tenacity import AsyncRetrying, RetryCallState, retry_if_exception, stop_after_attempt, wait_random_exponential
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import SystemMessage
 from langchain_core.prompts import PromptTemplate, ChatPromptTemplate, HumanMessagePromptTemplate
@@ -9,16 +17,218 @@ from langchain_core.output_parsers import StrOutputParser
 from langchain_ibm import WatsonxLLM
 
 from app.options import Options, LLMOptions
+from app.tokenizer import get_token_count
 from app.logger import setup_logger
 
 logger = setup_logger("bot")
 
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+OVERLOAD_STATUS_CODES = {429, 500, 502, 503, 504}
+# connection failures and timeouts of the OpenAI client (httpx) and the watsonx client (requests)
+TRANSPORT_ERRORS = (
+    asyncio.TimeoutError,
+    ConnectionError,
+    openai.APIConnectionError,
+    httpx.TimeoutException,
+    httpx.NetworkError,
+    httpx.RemoteProtocolError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+
+# requests on the summary critical path are admitted before per-file reviews when the token budget is tight
+PRIORITY_HIGH = 0
+PRIORITY_LOW = 1
+MAX_RETRY_WAIT_SECONDS = 120
+
+
+def get_status_code(error: BaseException) -> Optional[int]:
+    """HTTP status code carried by an OpenAI, httpx/requests or watsonx error, if any."""
+    for attr in ("status_code", "status", "http_status"):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(error, "response", None)
+    value = getattr(response, "status_code", None)
+    return value if isinstance(value, int) else None
+
+
+def get_retry_after(error: BaseException) -> Optional[float]:
+    """Seconds to wait according to the Retry-After header of a rate-limited response, if any."""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+
+    value = headers.get("retry-after-ms") or headers.get("Retry-After-Ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Only transport errors and transient HTTP statuses are retried; any other error would fail again."""
+    if isinstance(error, TRANSPORT_ERRORS):
+        return True
+    return get_status_code(error) in RETRYABLE_STATUS_CODES
+
+
+def wait_for_retry(retry_state: RetryCallState) -> float:
+    """Jittered exponential backoff that never retries earlier than the server asked for."""
+    backoff = wait_random_exponential(multiplier=1, max=60)(retry_state)
+    retry_after = get_retry_after(retry_state.outcome.exception())
+    if retry_after is None:
+        return backoff
+    return min(max(backoff, retry_after), MAX_RETRY_WAIT_SECONDS)
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD concurrency limit for the requests sent to one model.
+
+    The limit grows by one slot per `limit` successful requests while their latency stays within
+    `latency_tolerance` times the running average, and halves when the endpoint answers with a rate limit,
+    a server error or times out. Requests admitted before the last decrease were sent under the previous limit,
+    so their failures do not halve it again: a burst of failures decreases it once. It starts at `initial_limit`
+    and stays within [min_limit, max_limit].
+    """
+
+    def __init__(self, initial_limit: int, max_limit: int, min_limit: int = 1, latency_tolerance: float = 2.0):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial_limit, self.min_limit), self.max_limit))
+        self.latency_tolerance = latency_tolerance
+        self.average_latency: Optional[float] = None
+        self.in_flight = 0
+        self.decreases = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self) -> int:
+        """Wait for a free slot. Returns the number of decreases so far, to be passed back to `release`."""
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+            return self.decreases
+
+    async def release(self, decreases: int, latency: Optional[float] = None, overloaded: bool = False):
+        async with self.condition:
+            self.in_flight -= 1
+            if overloaded:
+                if decreases == self.decreases:
+                    self.decreases += 1
+                    self.limit = max(float(self.min_limit), self.limit / 2)
+                    logger.info(f"LLM endpoint overloaded, concurrency limit decreased to {int(self.limit)}")
+            elif latency is not None:
+                if self.average_latency is None:
+                    self.average_latency = latency
+                healthy = latency <= self.average_latency * self.latency_tolerance
+                self.average_latency = 0.8 * self.average_latency + 0.2 * latency
+                if healthy and self.limit < self.max_limit:
+                    previous_limit = int(self.limit)
+                    self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+                    if int(self.limit) > previous_limit:
+                        logger.debug(f"LLM concurrency limit increased to {int(self.limit)}")
+            self.condition.notify_all()
+
+
+class TokenBudget:
+    """Token buckets for provider tokens-per-minute and requests-per-minute quotas, shared by all bots.
+
+    Every request is charged its prompt tokens plus the response tokens it may generate. Requests that do not fit
+    wait until the buckets refill, and waiting requests are admitted by priority, then in arrival order.
+    A limit of 0 disables that bucket.
+    """
+
+    def __init__(self, tokens_per_minute: int = 0, requests_per_minute: int = 0):
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.tokens = float(tokens_per_minute)
+        self.requests = float(requests_per_minute)
+        self.updated_at = time.monotonic()
+        self.waiters = []
+        self.sequence = itertools.count()
+        self.condition = asyncio.Condition()
+
+    @property
+    def enabled(self) -> bool:
+        return self.tokens_per_minute > 0 or self.requests_per_minute > 0
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        if self.tokens_per_minute > 0:
+            self.tokens = min(float(self.tokens_per_minute), self.tokens + elapsed * self.tokens_per_minute / 60)
+        if self.requests_per_minute > 0:
+            self.requests = min(float(self.requests_per_minute),
+                                self.requests + elapsed * self.requests_per_minute / 60)
+
+    def _delay(self, tokens: int) -> float:
+        """Seconds until both buckets can pay for a request of `tokens` tokens."""
+        delay = 0.0
+        if self.tokens_per_minute > 0 and self.tokens < tokens:
+            delay = max(delay, (tokens - self.tokens) * 60 / self.tokens_per_minute)
+        if self.requests_per_minute > 0 and self.requests < 1:
+            delay = max(delay, (1 - self.requests) * 60 / self.requests_per_minute)
+        return delay
+
+    async def acquire(self, tokens: int, priority: int = PRIORITY_HIGH):
+        if not self.enabled:
+            return
+
+        if self.tokens_per_minute > 0:
+            # a request larger than the whole bucket would otherwise wait forever
+            tokens = min(tokens, self.tokens_per_minute)
+
+        entry = (priority, next(self.sequence))
+        async with self.condition:
+            heapq.heappush(self.waiters, entry)
+            try:
+                while True:
+                    self._refill()
+                    delay = None
+                    if self.waiters[0] == entry:
+                        delay = self._delay(tokens)
+                        if delay <= 0:
+                            heapq.heappop(self.waiters)
+                            if self.tokens_per_minute > 0:
+                                self.tokens -= tokens
+                            if self.requests_per_minute > 0:
+                                self.requests -= 1
+                            self.condition.notify_all()
+                            return
+                    try:
+                        await asyncio.wait_for(self.condition.wait(), timeout=delay)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                if entry in self.waiters:
+                    self.waiters.remove(entry)
+                    heapq.heapify(self.waiters)
+                    self.condition.notify_all()
+                raise
+
 
 class Bot:
-    def __init__(self, options: Options, llm_options: LLMOptions):
+    def __init__(self, options: Options, llm_options: LLMOptions, budget: TokenBudget = None):
         self.options = options
         self.llm_options = llm_options
+        self.budget = budget if budget else TokenBudget()
         self.api = None
+        self.limiter = AdaptiveConcurrencyLimiter(options.llm_concurrency_limit, options.llm_max_concurrency_limit)
         current_date = datetime.now().strftime("%Y-%m-%d")
         self.system_message = (
             f"{options.system_message}\n"
@@ -40,7 +250,10 @@ class Bot:
                     openai_organization=os.environ.get("OPENAI_API_ORG", None),
                     max_tokens=llm_options.token_limits.response_tokens,
                     temperature=options.llm_model_temperature,
-                    model=llm_options.model
+                    model=llm_options.model,
+                    # retries and timeouts are handled by Bot.chat
+                    max_retries=0,
+                    request_timeout=options.llm_timeout_ms / 1000
                 )
                 self.api = prompt | llm | output_parser
             else:
@@ -80,12 +293,26 @@ class Bot:
         else:
             raise Exception(f"{options.api_type} API is not supported")
 
-    @retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
-    async def chat(self, message: str):
+    async def chat(self, message: str, priority: int = PRIORITY_HIGH):
         start = time.time()
         response_text = ""
+        cost = 0
+        if self.budget.enabled:
+            cost = get_token_count(message, self.llm_options.model) + self.llm_options.token_limits.response_tokens
         try:
-            response_text = await self.api.ainvoke({"human_input": message})
+            async for attempt in AsyncRetrying(
+                    stop=stop_after_attempt(self.options.llm_retries + 1),
+                    wait=wait_for_retry,
+                    retry=retry_if_exception(is_retryable),
+                    before_sleep=lambda retry_state: logger.warning(
+                        f"Retrying {self.options.api_type} request (attempt {retry_state.attempt_number}): "
+                        f"{retry_state.outcome.exception()}"
+                    ),
+                    reraise=True
+            ):
+                with attempt:
+                    await self.budget.acquire(cost, priority)
+                    response_text = await self._invoke(message)
         except Exception as e:
             logger.error(f"Failed to send message to {self.options.api_type}: {e}")
 
@@ -100,10 +327,28 @@ class Bot:
 
         return response_text
 
+    async def _invoke(self, message: str) -> str:
+        decreases = await self.limiter.acquire()
+        start = time.monotonic()
+        latency = None
+        overloaded = False
+        try:
+            # a per-attempt deadline, so one stuck request cannot stall every other coroutine waiting on it
+            response_text = await asyncio.wait_for(
+                self.api.ainvoke({"human_input": message}),
+                timeout=self.options.llm_timeout_ms / 1000
+            )
+            latency = time.monotonic() - start
+            return response_text
+        except Exception as e:
+            overloaded = isinstance(e, asyncio.TimeoutError) or get_status_code(e) in OVERLOAD_STATUS_CODES
+            raise
+        finally:
+            await self.limiter.release(decreases, latency, overloaded)
+
 
 if __name__ == "__main__":
     # test
-    import asyncio
 
     openai_option = Options(True, False, False,
                             llm_light_model="gpt-3.5-turbo", api_type="openai",
@@ -0,0 +1,73 @@
+import os
+import json
+import hashlib
+import tempfile
+from typing import Any, Optional
+from app.logger import setup_logger
+
+logger = setup_logger("cache")
+
+
+class ResultCache:
+    """Content-addressed JSON store on disk.
+
+    Entries are keyed by a hash of everything that determines the result, so they never need invalidating.
+    Point `cache_dir` at a directory restored and saved by actions/cache to share results between runs.
+    An empty directory disables the cache.
+    """
+
+    def __init__(self, directory: str, namespace: str):
+        self.directory = os.path.join(directory, namespace) if directory else ""
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    @staticmethod
+    def key(*parts: str) -> str:
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> Optional[Any]:
+        if not self.enabled:
+            return None
+
+        try:
+            with open(self._path(key), "r") as file:
+                value = json.load(file)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception as e:
+            logger.warning(f"Failed to read cache entry {key}: {e}")
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any):
+        if not self.enabled:
+            return
+
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write to a temporary file first so concurrent readers never see a partial entry
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "w") as file:
+                json.dump(value, file)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.warning(f"Failed to write cache entry {key}: {e}")
+
+    def stats(self) -> str:
+        return f"hits: {self.hits}, misses: {self.misses}"
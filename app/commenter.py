@@ -1,7 +1,10 @@
 import os
 import re
-from typing import List, Dict, Optional
+import bisect
+import asyncio
+from typing import Any, Awaitable, Callable, List, Dict, Optional, Set, Tuple
 from github import Repository, IssueComment, PullRequestComment
+from app.github_client import AsyncGitHub, get_rate_limit_wait
 from app.logger import setup_logger
 
 logger = setup_logger("commenter")
@@ -22,12 +25,125 @@ SHORT_SUMMARY_END_TAG = "-->\n<!-- end of auto-generated comment: short summary
 COMMIT_ID_START_TAG = "<!-- commit_ids_reviewed_start -->"
 COMMIT_ID_END_TAG = "<!-- commit_ids_reviewed_end -->"
 
+# reviews posted at the same time when the bulk review is rejected; GitHub penalizes bursts of content creation
+FALLBACK_CONCURRENCY = 3
+# groups of at most this many comments are posted one by one instead of being bisected further
+FALLBACK_SINGLE_COMMENTS = 2
+
+
+def generate_comment_data(comment: Dict) -> Dict:
+    return {
+        "path": comment["path"],
+        "body": comment["message"],
+        "line": comment["end_line"],
+        "start_line": comment["start_line"] if comment["start_line"] != comment["end_line"] else None
+    }
+
+
+def get_comment_lines(comment: PullRequestComment) -> Tuple[Optional[int], Optional[int]]:
+    """(start_line, line) of a review comment."""
+    if hasattr(comment, "line"):
+        return comment.start_line, comment.line
+    # PyGithub 2.3.0 has no properties for them, although the API returns them; the raw data is read without
+    # completing the object, which would request the comment again
+    return comment._rawData.get("start_line"), comment._rawData.get("line")
+
+
+class ReviewCommentIndex:
+    """Review comments of a pull request indexed by id, by reply parent and by path and line range.
+
+    Range lookups bisect the comments of a path sorted by start line, so finding the comments of a hunk costs
+    O(log n + k) instead of a scan over every comment of the pull request. Results keep the order in which
+    GitHub listed the comments.
+    """
+
+    def __init__(self, comments: List[PullRequestComment]):
+        self.comments = comments
+        self.by_id: Dict[int, PullRequestComment] = {}
+        self.children: Dict[int, List[PullRequestComment]] = {}
+        self.position: Dict[int, int] = {}
+        self.start_lines: Dict[int, Optional[int]] = {}
+        # path -> (start lines, (end line, comment)) sorted by start line, for comments spanning several lines
+        self.ranges: Dict[str, tuple] = {}
+        # path -> end line -> comments
+        self.lines: Dict[str, Dict[int, List[PullRequestComment]]] = {}
+
+        ranged: Dict[str, List[PullRequestComment]] = {}
+        for position, comment in enumerate(comments):
+            self.by_id[comment.id] = comment
+            self.position[comment.id] = position
+            if comment.in_reply_to_id:
+                self.children.setdefault(comment.in_reply_to_id, []).append(comment)
+            start_line, line = get_comment_lines(comment)
+            # comments on outdated diffs have no line and never match a range
+            if not comment.body or line is None:
+                continue
+            self.start_lines[comment.id] = start_line
+            self.lines.setdefault(comment.path, {}).setdefault(line, []).append(comment)
+            if start_line is not None:
+                ranged.setdefault(comment.path, []).append((start_line, line, comment))
+
+        for path, path_comments in ranged.items():
+            path_comments.sort(key=lambda entry: entry[0])
+            self.ranges[path] = ([start_line for start_line, _, _ in path_comments],
+                                 [(line, comment) for _, line, comment in path_comments])
+
+    def _in_order(self, comments: Dict[int, PullRequestComment]) -> List[PullRequestComment]:
+        return sorted(comments.values(), key=lambda cmt: self.position[cmt.id])
+
+    def within_range(self, path: str, start_line: int, end_line: int) -> List[PullRequestComment]:
+        """Comments starting and ending within the lines, or on the line itself for a single-line range."""
+        found: Dict[int, PullRequestComment] = {}
+        if path in self.ranges:
+            start_lines, path_comments = self.ranges[path]
+            # a comment ending at or before end_line also starts at or before it
+            for i in range(bisect.bisect_left(start_lines, start_line), bisect.bisect_right(start_lines, end_line)):
+                line, comment = path_comments[i]
+                if line <= end_line:
+                    found[comment.id] = comment
+        if start_line == end_line:
+            for comment in self.lines.get(path, {}).get(end_line, []):
+                found[comment.id] = comment
+        return self._in_order(found)
+
+    def at_range(self, path: str, start_line: int, end_line: int) -> List[PullRequestComment]:
+        """Comments spanning exactly the lines, or on the line itself for a single-line range."""
+        found: Dict[int, PullRequestComment] = {}
+        for comment in self.lines.get(path, {}).get(end_line, []):
+            if self.start_lines[comment.id] == start_line or start_line == end_line:
+                found[comment.id] = comment
+        return self._in_order(found)
+
+    def replies(self, comment_id: int) -> List[PullRequestComment]:
+        return self.children.get(comment_id, [])
+
+    def top_level(self, comment: PullRequestComment) -> PullRequestComment:
+        top_level_comment = comment
+        seen = set()
+        while top_level_comment.in_reply_to_id and top_level_comment.id not in seen:
+            seen.add(top_level_comment.id)
+            parent_comment = self.by_id.get(top_level_comment.in_reply_to_id)
+            if not parent_comment:
+                break
+            top_level_comment = parent_comment
+        return top_level_comment
+
 
 class Commenter:
-    def __init__(self, repo: Repository):
+    def __init__(self, repo: Repository, github: AsyncGitHub = None):
         self.repo = repo
-        self.review_comments_cache: Dict[int, List[PullRequestComment]] = {}
+        self.github = github if github else AsyncGitHub(repo)
+        self.review_comments_cache: Dict[int, ReviewCommentIndex] = {}
         self.issue_comments_cache: Dict[int, List[IssueComment]] = {}
+        self.commit_ids_cache: Dict[int, List[str]] = {}
+        # PyGithub objects fetched during this run, shared by concurrent callers while the request is in flight
+        self.pulls: Dict[int, asyncio.Future] = {}
+        self.issues: Dict[int, asyncio.Future] = {}
+        self.commits: Dict[str, asyncio.Future] = {}
+        # listings in flight, so that concurrent callers missing the caches above share one paginated fetch
+        self.review_comments_fetches: Dict[int, asyncio.Future] = {}
+        self.issue_comments_fetches: Dict[int, asyncio.Future] = {}
+        self.commit_ids_fetches: Dict[int, asyncio.Future] = {}
         self.review_comments_buffer: List[Dict] = []
 
     def _get_target(self, context: Dict) -> Optional[int]:
@@ -40,8 +156,33 @@ class Commenter:
             logger.warning("Skipped: context.payload.pull_request and context.payload.issue are both null")
             return None
 
-    def get_pull_request_comment(self, pull_number: int, comment_id: int) -> PullRequestComment:
-        return self.repo.get_pull(pull_number).get_review_comment(comment_id)
+    @staticmethod
+    async def _memoized(cache: Dict[Any, asyncio.Future], key: Any, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        if key not in cache:
+            cache[key] = asyncio.ensure_future(fetch())
+        try:
+            return await cache[key]
+        except Exception:
+            cache.pop(key, None)
+            raise
+
+    async def get_pull(self, pull_number: int, refresh: bool = False):
+        if refresh:
+            self.invalidate_pull(pull_number)
+        return await self._memoized(self.pulls, pull_number, lambda: self.github.get_pull(pull_number))
+
+    async def get_issue(self, number: int):
+        return await self._memoized(self.issues, number, lambda: self.github.get_issue(number))
+
+    async def get_commit(self, sha: str):
+        return await self._memoized(self.commits, sha, lambda: self.github.get_commit(sha))
+
+    def invalidate_pull(self, pull_number: int):
+        self.pulls.pop(pull_number, None)
+
+    async def get_pull_request_comment(self, pull_number: int, comment_id: int) -> PullRequestComment:
+        pr = await self.get_pull(pull_number)
+        return await self.github.run(pr.get_review_comment, comment_id)
 
     async def comment(self, message: str, tag: str, mode: str, target: int):
         if not tag:
@@ -56,7 +197,8 @@ class Commenter:
 
     async def create(self, body: str, target: int):
         try:
-            comment = self.repo.get_issue(number=target).create_comment(body)
+            issue = await self.get_issue(target)
+            comment = await self.github.run(issue.create_comment, body)
             if target in self.issue_comments_cache:
                 self.issue_comments_cache[target].append(comment)
             else:
@@ -68,7 +210,7 @@ class Commenter:
         try:
             cmt = await self.find_comment_with_tag(tag, target)
             if cmt:
-                cmt.edit(body=body)
+                await self.github.run(cmt.edit, body=body)
             else:
                 await self.create(body, target)
         except Exception as e:
@@ -110,13 +252,17 @@ class Commenter:
 
     async def update_description(self, pull_number: int, message: str):
         try:
-            pr = self.repo.get_pull(pull_number)
+            # the description may have been edited since the pull request was fetched
+            pr = await self.get_pull(pull_number, refresh=True)
             body = pr.body or ""
             description = self.get_description(body)
 
             message_clean = self.remove_content_within_tags(message, DESCRIPTION_START_TAG, DESCRIPTION_END_TAG)
             new_description = f"{description}\n{DESCRIPTION_START_TAG}\n{message_clean}\n{DESCRIPTION_END_TAG}"
-            pr.edit(body=new_description)
+            try:
+                await self.github.run(pr.edit, body=new_description)
+            finally:
+                self.invalidate_pull(pull_number)
         except Exception as e:
             logger.warning(f"Failed to get PR: {e}, skipping adding release notes to description.")
 
@@ -131,13 +277,15 @@ class Commenter:
 
     async def delete_pending_review(self, pull_number: int):
         try:
-            reviews = list(self.repo.get_pull(pull_number).get_reviews())
+            pr = await self.get_pull(pull_number)
+            reviews = await self.github.list(pr.get_reviews())
             pending_review = next((review for review in reviews if review.state == "PENDING"), None)
 
             if pending_review:
                 logger.info(f"Deleting pending review for PR #{pull_number} id: {pending_review.id}")
                 try:
-                    self.repo.get_pull(pull_number).get_review(pending_review.id).dismiss("Removing pending review")
+                    # a pending review cannot be dismissed, only deleted
+                    await self.github.run(pending_review.delete)
                 except Exception as e:
                     logger.warning(f"Failed to delete pending review: {e}")
         except Exception as e:
@@ -149,8 +297,10 @@ class Commenter:
         if len(self.review_comments_buffer) == 0:
             logger.info(f"Submitting empty review for PR #{pull_number}")
             try:
-                self.repo.get_pull(pull_number).create_review(
-                    commit=self.repo.get_commit(sha=commit_id),
+                pr = await self.get_pull(pull_number)
+                await self.github.run(
+                    pr.create_review,
+                    commit=await self.get_commit(commit_id),
                     event="COMMENT",
                     body=body
                 )
@@ -159,15 +309,10 @@ class Commenter:
             return
 
         try:
-            generate_comment_data = lambda comment: {
-                "path": comment["path"],
-                "body": comment["message"],
-                "line": comment["end_line"],
-                "start_line": comment["start_line"] if comment["start_line"] != comment["end_line"] else None
-            }
-
-            review = self.repo.get_pull(pull_number).create_review(
-                commit=self.repo.get_commit(sha=commit_id),
+            pr = await self.get_pull(pull_number)
+            review = await self.github.run_with_backoff(
+                pr.create_review,
+                commit=await self.get_commit(commit_id),
                 event="COMMENT",
                 comments=[generate_comment_data(comment) for comment in self.review_comments_buffer]
             )
@@ -176,34 +321,97 @@ class Commenter:
                         f"total comments: {len(self.review_comments_buffer)}, review id: {review.id}")
 
         except Exception as e:
-            logger.warning(f"Failed to create review: {e}. Falling back to individual comments.")
+            logger.warning(f"Failed to create review: {e}. Falling back to smaller reviews.")
             await self.delete_pending_review(pull_number)
 
-            for i, comment in enumerate(self.review_comments_buffer, start=1):
-                try:
-                    self.repo.get_pull(pull_number).create_review_comment(
-                        commit=self.repo.get_commit(sha=commit_id),
-                        path=comment["path"],
-                        body=comment["message"],
-                        line=comment["end_line"],
-                        start_line=comment["start_line"] if comment["start_line"] != comment["end_line"] else None
-                    )
-                    logger.info(f"Comment {i}/{len(self.review_comments_buffer)} posted")
-                except Exception as ee:
-                    logger.warning(f"Failed to create review comment: {ee}")
+            try:
+                pr = await self.get_pull(pull_number)
+                commit = await self.get_commit(commit_id)
+            except Exception as ee:
+                logger.warning(f"Failed to get PR or commit: {ee}")
+                return
+
+            semaphore = asyncio.Semaphore(FALLBACK_CONCURRENCY)
+            # the whole buffer was just rejected, so the first retry is already split
+            failed = await self.split_review_comments(pull_number, pr, commit, self.review_comments_buffer, semaphore)
+            logger.info(f"Fallback review for PR #{pull_number}: "
+                        f"{len(self.review_comments_buffer) - len(failed)}/{len(self.review_comments_buffer)} "
+                        f"comments posted")
+
+    async def post_review_comments(self, pull_number: int, pr, commit, comments: List[Dict],
+                                   semaphore: asyncio.Semaphore) -> List[Dict]:
+        """Post the comments as reviews, bisecting around the ones GitHub rejects. Returns the rejected comments."""
+        if len(comments) <= FALLBACK_SINGLE_COMMENTS:
+            return await self.split_review_comments(pull_number, pr, commit, comments, semaphore)
+
+        try:
+            async with semaphore:
+                await self.github.run_with_backoff(
+                    pr.create_review,
+                    commit=commit,
+                    event="COMMENT",
+                    comments=[generate_comment_data(comment) for comment in comments]
+                )
+            return []
+        except Exception as e:
+            if get_rate_limit_wait(e) is not None:
+                logger.warning(f"Failed to create review of {len(comments)} comments, still rate limited: {e}")
+                return comments
+            logger.info(f"Failed to create review of {len(comments)} comments, splitting it: {e}")
+
+        return await self.split_review_comments(pull_number, pr, commit, comments, semaphore)
+
+    async def split_review_comments(self, pull_number: int, pr, commit, comments: List[Dict],
+                                    semaphore: asyncio.Semaphore) -> List[Dict]:
+        """Post the two halves of the comments as separate reviews, or the comments one by one when only a few are
+        left. Returns the rejected comments."""
+        if not comments:
+            return []
+
+        if len(comments) <= FALLBACK_SINGLE_COMMENTS:
+            posted = await asyncio.gather(*[self.post_review_comment(pr, commit, comment, semaphore)
+                                            for comment in comments])
+            return [comment for comment, ok in zip(comments, posted) if not ok]
+
+        middle = len(comments) // 2
+        first, second = await asyncio.gather(
+            self.post_review_comments(pull_number, pr, commit, comments[:middle], semaphore),
+            self.post_review_comments(pull_number, pr, commit, comments[middle:], semaphore)
+        )
+        return first + second
+
+    async def post_review_comment(self, pr, commit, comment: Dict, semaphore: asyncio.Semaphore) -> bool:
+        try:
+            async with semaphore:
+                await self.github.run_with_backoff(
+                    pr.create_review_comment,
+                    commit=commit,
+                    path=comment["path"],
+                    body=comment["message"],
+                    line=comment["end_line"],
+                    start_line=comment["start_line"] if comment["start_line"] != comment["end_line"] else None
+                )
+            return True
+        except Exception as e:
+            logger.warning(f"Failed to create review comment on {comment['path']}:{comment['end_line']}: {e}")
+            return False
 
     async def review_comment_reply(self, pull_number: int, top_level_comment: PullRequestComment, message: str):
         reply = f"{COMMENT_GREETING}\n\n{message}\n\n{COMMENT_REPLY_TAG}"
 
         try:
-            self.repo.get_pull(pull_number).create_review_comment_reply(
+            pr = await self.get_pull(pull_number)
+            await self.github.run(
+                pr.create_review_comment_reply,
                 body=reply,
                 comment_id=top_level_comment.id
             )
         except Exception as e:
             logger.warning(f"Failed to reply to the top-level comment {e}")
             try:
-                self.repo.get_pull(pull_number).create_review_comment_reply(
+                pr = await self.get_pull(pull_number)
+                await self.github.run(
+                    pr.create_review_comment_reply,
                     body=f"Could not post the reply due to the following error: {e}",
                     comment_id=top_level_comment.id
                 )
@@ -213,98 +421,91 @@ class Commenter:
         try:
             if COMMENT_TAG in top_level_comment.body:
                 new_body = top_level_comment.body.replace(COMMENT_TAG, COMMENT_REPLY_TAG)
-                top_level_comment.edit(body=new_body)
+                await self.github.run(top_level_comment.edit, body=new_body)
         except Exception as error:
             logger.warning(f"Failed to update the top-level comment {error}")
 
     async def get_comments_within_range(self, pull_number: int, path: str, start_line: int, end_line: int):
-        comments = await self.list_review_comments(pull_number)
-        return [
-            comment for comment in comments
-            if comment.path == path and
-               comment.body and
-               ((comment.start_line is not None and comment.start_line >= start_line and comment.line <= end_line) or
-                (start_line == end_line and comment.line == end_line))
-        ]
+        index = await self.get_review_comment_index(pull_number)
+        return index.within_range(path, start_line, end_line)
 
     async def get_comments_at_range(self, pull_number: int, path: str, start_line: int, end_line: int):
-        comments = await self.list_review_comments(pull_number)
-        return [
-            comment for comment in comments
-            if comment.path == path and
-               comment.body and
-               ((comment.start_line is not None and comment.start_line == start_line and comment.line == end_line) or
-                (start_line == end_line and comment.line == end_line))
-        ]
+        index = await self.get_review_comment_index(pull_number)
+        return index.at_range(path, start_line, end_line)
 
     async def get_comment_chains_within_range(self, pull_number: int, path: str, start_line: int, end_line: int,
                                               tag=""):
-        existing_comments = await self.get_comments_within_range(pull_number, path, start_line, end_line)
+        index = await self.get_review_comment_index(pull_number)
+        existing_comments = index.within_range(path, start_line, end_line)
+        existing_ids = {comment.id for comment in existing_comments}
         top_level_comments = [comment for comment in existing_comments if not comment.in_reply_to_id]
 
         all_chains = ""
         for chain_num, top_level_comment in enumerate(top_level_comments, start=1):
-            chain = await self.compose_comment_chain(existing_comments, top_level_comment)
+            chain = await self.compose_comment_chain(index, top_level_comment, existing_ids)
             if chain and tag in chain:
                 all_chains += f"Conversation Chain {chain_num}:\n{chain}\n---\n"
 
         return all_chains
 
-    async def compose_comment_chain(self, review_comments: List[PullRequestComment],
-                                    top_level_comment: PullRequestComment) -> str:
+    async def compose_comment_chain(self, index: ReviewCommentIndex, top_level_comment: PullRequestComment,
+                                    comment_ids: Optional[Set[int]] = None) -> str:
+        """Join the top-level comment with its replies, restricted to `comment_ids` when given."""
         conversation_chain = [
                                  f"{top_level_comment.user.login}: {top_level_comment.body}"
                              ] + [
                                  f"{cmt.user.login}: {cmt.body}"
-                                 for cmt in review_comments
-                                 if cmt.in_reply_to_id == top_level_comment.id
+                                 for cmt in index.replies(top_level_comment.id)
+                                 if comment_ids is None or cmt.id in comment_ids
                              ]
 
         return "\n---\n".join(conversation_chain)
 
     async def get_comment_chain(self, pull_number: int, comment: PullRequestComment):
         try:
-            review_comments = await self.list_review_comments(pull_number)
-            top_level_comment = await self.get_top_level_comment(review_comments, comment)
-            chain = await self.compose_comment_chain(review_comments, top_level_comment)
+            index = await self.get_review_comment_index(pull_number)
+            top_level_comment = await self.get_top_level_comment(index, comment)
+            chain = await self.compose_comment_chain(index, top_level_comment)
             return {"chain": chain, "top_level_comment": top_level_comment}
         except Exception as e:
             logger.warning(f"Failed to get conversation chain: {e}")
             return {"chain": "", "top_level_comment": None}
 
-    async def get_top_level_comment(self, review_comments: List[PullRequestComment],
+    async def get_top_level_comment(self, index: ReviewCommentIndex,
                                     comment: PullRequestComment) -> PullRequestComment:
-        top_level_comment = comment
-
-        while top_level_comment.in_reply_to_id:
-            parent_comment = next((cmt for cmt in review_comments if cmt.id == top_level_comment.in_reply_to_id), None)
-
-            if parent_comment:
-                top_level_comment = parent_comment
-            else:
-                break
-
-        return top_level_comment
+        return index.top_level(comment)
 
     async def list_review_comments(self, target: int) -> List[PullRequestComment]:
+        index = await self.get_review_comment_index(target)
+        return index.comments
+
+    async def get_review_comment_index(self, target: int) -> ReviewCommentIndex:
         if target in self.review_comments_cache:
             return self.review_comments_cache[target]
+        return await self._memoized(self.review_comments_fetches, target,
+                                    lambda: self._fetch_review_comment_index(target))
 
+    async def _fetch_review_comment_index(self, target: int) -> ReviewCommentIndex:
         try:
-            all_comments = list(self.repo.get_pull(target).get_review_comments())
+            pr = await self.get_pull(target)
+            all_comments = await self.github.list(pr.get_review_comments())
         except Exception as e:
             logger.warning(f"Failed to list review comments: {e}")
             all_comments = []
 
-        self.review_comments_cache[target] = all_comments
-        return all_comments
+        index = ReviewCommentIndex(all_comments)
+        self.review_comments_cache[target] = index
+        return index
 
     async def list_comments(self, target: int) -> List[IssueComment]:
         if target in self.issue_comments_cache:
             return self.issue_comments_cache[target]
+        return await self._memoized(self.issue_comments_fetches, target, lambda: self._fetch_comments(target))
 
+    async def _fetch_comments(self, target: int) -> List[IssueComment]:
         try:
-            all_comments = list(self.repo.get_issue(number=target).get_comments())
+            issue = await self.get_issue(target)
+            all_comments = await self.github.list(issue.get_comments())
         except Exception as e:
             logger.warning(f"Failed to list comments: {e}")
             all_comments = []
@@ -345,13 +546,22 @@ class Commenter:
         return ""
 
     async def get_all_commit_ids(self, pull_number: int) -> List[str]:
+        if pull_number in self.commit_ids_cache:
+            return self.commit_ids_cache[pull_number]
+        return await self._memoized(self.commit_ids_fetches, pull_number,
+                                    lambda: self._fetch_commit_ids(pull_number))
+
+    async def _fetch_commit_ids(self, pull_number: int) -> List[str]:
         all_commits = []
         try:
-            commits = list(self.repo.get_pull(pull_number).get_commits())
+            pr = await self.get_pull(pull_number)
+            commits = await self.github.list(pr.get_commits())
             all_commits.extend([commit.sha for commit in commits])
         except Exception as e:
             logger.warning(f"Failed to list commits: {e}")
+            return all_commits
 
+        self.commit_ids_cache[pull_number] = all_commits
         return all_commits
 
     def add_in_progress_status(self, comment_body: str, status_msg: str) -> str:
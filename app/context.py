@@ -3,6 +3,8 @@ import json
 from github import Github
 from github.Repository import Repository
 from app.commenter import Commenter
+from app.github_client import AsyncGitHub, get_requester
+from app.http_cache import ConditionalRequestCache
 from app.logger import setup_logger
 
 logger = setup_logger("context")
@@ -26,6 +28,9 @@ if not repository:
 else:
     logger.debug(f"GITHUB_REPOSITORY:{repository}")
 repo: Repository = github_client.get_repo(repository)
+http_cache = ConditionalRequestCache(os.getenv("INPUT_CACHE_DIR", ""))
+if http_cache.enabled:
+    http_cache.install(get_requester(repo))
 
 redirect_event_name = os.getenv("REDIRECT_EVENT_NAME")
 if not redirect_event_name:
@@ -68,4 +73,5 @@ context = {
 # comment_data = context.get("comment")
 
 ignore_keyword = "@SeineSailor: ignore"
-commenter = Commenter(repo)
+github = AsyncGitHub(repo, int(os.getenv("INPUT_GITHUB_CONCURRENCY_LIMIT", "6")))
+commenter = Commenter(repo, github)
@@ -0,0 +1,147 @@
+import asyncio
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from github.File import File
+from github.PaginatedList import PaginatedList
+from app.github_client import AsyncGitHub, get_requester
+from app.local_git import LocalComparison, LocalGit
+from app.logger import setup_logger
+
+logger = setup_logger("diff")
+
+# the compare API lists at most this many files
+COMPARE_FILES_LIMIT = 300
+# the pull request files API lists at most this many files
+PULL_FILES_LIMIT = 3000
+PULL_FILES_PER_PAGE = 100
+
+# compare results already fetched during this run, keyed by (base, head)
+_comparisons: Dict[Tuple[str, str], asyncio.Task] = {}
+
+
+async def _compare(github: AsyncGitHub, base: str, head: str, local: Optional[LocalGit]):
+    if local:
+        try:
+            comparison = await local.compare(base, head)
+            if comparison is not None:
+                return comparison
+        except Exception as e:
+            logger.warning(f"Failed to compare {base}...{head} in the local clone: {e}")
+        logger.info(f"comparing {base}...{head} through the GitHub API")
+    return await github.compare(base, head)
+
+
+async def compare(github: AsyncGitHub, base: str, head: str, local: Optional[LocalGit] = None):
+    """Compare two commits, issuing at most one request per (base, head) pair per run."""
+    key = (base, head)
+    if key not in _comparisons:
+        _comparisons[key] = asyncio.ensure_future(_compare(github, base, head, local))
+    try:
+        return await _comparisons[key]
+    except Exception:
+        _comparisons.pop(key, None)
+        raise
+
+
+class PullRequestFiles:
+    """The files of a pull request, listed one page of `pulls/{n}/files` at a time.
+
+    Iterating requests the next page only when the previous one has been consumed, so a consumer that stops
+    early stops the listing, and no more than one page is held at once. `limit_reached` tells whether the
+    listing ended at the API limit rather than at the last file.
+    """
+
+    def __init__(self, github: AsyncGitHub, pull_number: int):
+        self.github = github
+        self.pull_number = pull_number
+        self.limit_reached = False
+
+    def __aiter__(self) -> AsyncIterator[File]:
+        return self._iterate()
+
+    async def _iterate(self) -> AsyncIterator[File]:
+        # PaginatedList builds the File objects the way the installed PyGithub expects them
+        url = f"{self.github.repo.url}/pulls/{self.pull_number}/files"
+        pages = PaginatedList(File, get_requester(self.github.repo), url, {"per_page": PULL_FILES_PER_PAGE})
+        listed = 0
+        for page in range(PULL_FILES_LIMIT // PULL_FILES_PER_PAGE):
+            files = await self.github.run(pages.get_page, page)
+            for file in files:
+                yield file
+            listed += len(files)
+            if len(files) < PULL_FILES_PER_PAGE:
+                return
+        self.limit_reached = True
+        logger.warning(f"pull request #{self.pull_number} has more than {listed} files, "
+                       f"GitHub does not list the others")
+
+
+class DiffSnapshot:
+    """The files and commits of a pull request, fetched once and indexed by filename.
+
+    `files` covers the whole branch (base..head). `incremental_files` covers what changed since the last
+    reviewed commit; it is the same mapping when the review starts from the base commit.
+    """
+
+    def __init__(self, base_sha: str, head_sha: str, incremental_base_sha: str = None):
+        self.base_sha = base_sha
+        self.head_sha = head_sha
+        self.incremental_base_sha = incremental_base_sha or base_sha
+        self.files: Optional[Dict[str, File]] = None
+        self.incremental_files: Optional[Dict[str, File]] = None
+        self.commits: List = []
+        self.local = False
+
+    @classmethod
+    async def fetch(cls, github: AsyncGitHub, base_sha: str, head_sha: str,
+                    incremental_base_sha: str = None, local: Optional[LocalGit] = None) -> "DiffSnapshot":
+        snapshot = cls(base_sha, head_sha, incremental_base_sha)
+
+        if snapshot.incremental_base_sha == base_sha:
+            target_branch_diff = await compare(github, base_sha, head_sha, local)
+            incremental_diff = target_branch_diff
+        else:
+            target_branch_diff, incremental_diff = await asyncio.gather(
+                compare(github, base_sha, head_sha, local),
+                compare(github, snapshot.incremental_base_sha, head_sha, local)
+            )
+
+        if target_branch_diff.files is not None:
+            snapshot.files = {file.filename: file for file in target_branch_diff.files}
+        if incremental_diff is target_branch_diff:
+            snapshot.incremental_files = snapshot.files
+        elif incremental_diff.files is not None:
+            snapshot.incremental_files = {file.filename: file for file in incremental_diff.files}
+        snapshot.commits = incremental_diff.commits
+        snapshot.local = isinstance(target_branch_diff, LocalComparison)
+
+        return snapshot
+
+    @property
+    def complete(self) -> bool:
+        return self.files is not None and self.incremental_files is not None
+
+    @property
+    def truncated(self) -> bool:
+        """Whether the compare API may have left files out of `files`."""
+        return not self.local and self.files is not None and len(self.files) >= COMPARE_FILES_LIMIT
+
+    def touched(self, filename: str) -> bool:
+        """Whether the file changed since the last reviewed commit, assuming it did when the listing is cut."""
+        if self.incremental_files is self.files or self.incremental_files is None:
+            return True
+        if not self.local and len(self.incremental_files) >= COMPARE_FILES_LIMIT:
+            return True
+        return filename in self.incremental_files
+
+    def changed_files(self) -> List[File]:
+        """Branch files that were touched since the last reviewed commit, in compare order."""
+        if not self.complete:
+            return []
+        if self.incremental_files is self.files:
+            return list(self.files.values())
+        return [file for filename, file in self.files.items() if filename in self.incremental_files]
+
+    def get_file(self, filename: str) -> Optional[File]:
+        if self.files is None:
+            return None
+        return self.files.get(filename)
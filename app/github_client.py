@@ -0,0 +1,156 @@
+import time
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, List, Optional
+from github import GithubException
+from github.Repository import Repository
+from github.Requester import Requester
+from tenacity import AsyncRetrying, RetryCallState, retry_if_exception, stop_after_attempt
+from app.logger import setup_logger
+
+logger = setup_logger("github_client")
+
+RATE_LIMIT_RETRIES = 3
+# GitHub asks to wait at least a minute after hitting a secondary rate limit without a Retry-After header
+SECONDARY_RATE_LIMIT_WAIT_SECONDS = 60
+MAX_RATE_LIMIT_WAIT_SECONDS = 300
+
+
+def get_rate_limit_wait(error: BaseException) -> Optional[float]:
+    """Seconds to wait before retrying a request GitHub rejected for exceeding a rate limit, None for other errors."""
+    if not isinstance(error, GithubException) or error.status not in (403, 429):
+        return None
+
+    headers = {key.lower(): value for key, value in (error.headers or {}).items()}
+    try:
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+        if headers.get("x-ratelimit-remaining") == "0" and headers.get("x-ratelimit-reset"):
+            return max(0.0, float(headers["x-ratelimit-reset"]) - time.time())
+    except ValueError:
+        pass
+
+    if "rate limit" in str(error.data).lower() or error.status == 429:
+        return SECONDARY_RATE_LIMIT_WAIT_SECONDS
+    return None
+
+
+def wait_for_rate_limit(retry_state: RetryCallState) -> float:
+    return min(get_rate_limit_wait(retry_state.outcome.exception()) or 0.0, MAX_RATE_LIMIT_WAIT_SECONDS)
+
+
+def get_requester(github_object: Any) -> Optional[Requester]:
+    """The Requester of a PyGithub object; PyGithub 2.3.0 has no public `requester` property."""
+    return getattr(github_object, "requester", None) or getattr(github_object, "_requester", None)
+
+
+class ThreadLocalConnection:
+    """Gives every thread its own copy of a PyGithub connection.
+
+    All PyGithub objects of a client share one Requester and its single persistent connection, whose `request()`
+    stores the verb, URL, headers and body on the connection for `getresponse()` to read back. Two threads sending
+    at once can swap their requests. Installed as that connection, this hands each thread a connection built like
+    the original one.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.host = connection.host
+        self.port = connection.port
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = [connection]
+
+    @classmethod
+    def install(cls, requester: Requester):
+        # PyGithub has no option for this: its persistent connection is created, then replaced by the proxy
+        connection = requester._Requester__createConnection()
+        if not isinstance(connection, cls):
+            requester._Requester__connection = cls(connection)
+
+    def get(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            template = self.connection
+            connection = type(template)(template.host, template.port, retry=template.retry,
+                                        pool_size=template.pool_size, timeout=template.timeout,
+                                        verify=template.verify)
+            self.local.connection = connection
+            with self.lock:
+                self.connections.append(connection)
+        return connection
+
+    def request(self, *args, **kwargs):
+        return self.get().request(*args, **kwargs)
+
+    def getresponse(self):
+        return self.get().getresponse()
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            connection.close()
+        self.local = threading.local()
+
+
+class AsyncGitHub:
+    """Awaitable access to the GitHub REST API.
+
+    PyGithub is synchronous, so every call is dispatched to a bounded thread pool. The pool size is the
+    GitHub concurrency limit: coroutines awaiting these methods run their requests in parallel instead of
+    blocking the event loop one after another. Each thread of the pool sends its requests over its own
+    connection, see ThreadLocalConnection.
+    """
+
+    def __init__(self, repo: Repository, concurrency_limit: int = 6):
+        self.repo = repo
+        self.concurrency_limit = max(1, concurrency_limit)
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency_limit, thread_name_prefix="github")
+        requester = get_requester(repo)
+        if isinstance(requester, Requester):
+            ThreadLocalConnection.install(requester)
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        """Run a blocking PyGithub call (or any callable) on the GitHub thread pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    async def run_with_backoff(self, fn: Callable, *args, **kwargs) -> Any:
+        """Like `run`, waiting as long as GitHub asks and retrying when a request hits a rate limit."""
+        async for attempt in AsyncRetrying(
+                stop=stop_after_attempt(RATE_LIMIT_RETRIES + 1),
+                wait=wait_for_rate_limit,
+                retry=retry_if_exception(lambda error: get_rate_limit_wait(error) is not None),
+                before_sleep=lambda retry_state: logger.warning(
+                    f"GitHub rate limit hit, retrying in {wait_for_rate_limit(retry_state):.0f}s "
+                    f"(attempt {retry_state.attempt_number})"
+                ),
+                reraise=True
+        ):
+            with attempt:
+                return await self.run(fn, *args, **kwargs)
+
+    async def list(self, paginated: Iterable) -> List:
+        """Materialize a lazy PaginatedList without blocking the event loop."""
+        return await self.run(list, paginated)
+
+    async def get_pull(self, pull_number: int):
+        return await self.run(self.repo.get_pull, pull_number)
+
+    async def get_issue(self, number: int):
+        return await self.run(self.repo.get_issue, number=number)
+
+    async def get_commit(self, sha: str):
+        return await self.run(self.repo.get_commit, sha=sha)
+
+    async def compare(self, base: str, head: str):
+        return await self.run(self.repo.compare, base, head)
+
+    async def get_contents(self, path: str, ref: str):
+        return await self.run(self.repo.get_contents, path, ref=ref)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
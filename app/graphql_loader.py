@@ -0,0 +1,182 @@
+import asyncio
+from typing import Any, Dict, List, Optional
+from github.IssueComment import IssueComment
+from github.PullRequestComment import PullRequestComment
+from app.commenter import Commenter, ReviewCommentIndex
+from app.github_client import AsyncGitHub, get_requester
+from app.logger import setup_logger
+
+logger = setup_logger("graphql_loader")
+
+# number of file blobs requested in one query
+BLOBS_PER_QUERY = 50
+
+PULL_REQUEST_QUERY = """
+query($owner: String!, $name: String!, $number: Int!,
+      $commits: String, $comments: String, $threads: String,
+      $withCommits: Boolean!, $withComments: Boolean!, $withThreads: Boolean!) {
+  repository(owner: $owner, name: $name) {
+    pullRequest(number: $number) {
+      body
+      commits(first: 100, after: $commits) @include(if: $withCommits) {
+        pageInfo { hasNextPage endCursor }
+        nodes { commit { oid } }
+      }
+      comments(first: 100, after: $comments) @include(if: $withComments) {
+        pageInfo { hasNextPage endCursor }
+        nodes { databaseId body createdAt url author { login } }
+      }
+      reviewThreads(first: 100, after: $threads) @include(if: $withThreads) {
+        pageInfo { hasNextPage endCursor }
+        nodes {
+          comments(first: 100) {
+            pageInfo { hasNextPage }
+            nodes {
+              databaseId body createdAt url path line startLine originalLine originalStartLine diffHunk
+              author { login }
+              replyTo { databaseId }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+
+class PullRequestLoader:
+    """Loads the data `code_review` needs up front through a few GraphQL queries.
+
+    One paginated query returns the pull request body, its commits, issue comments and review threads, and
+    fills the `Commenter` caches with the same PyGithub objects the REST listings would have produced.
+    Base versions of the changed files are fetched by batches of aliased `object(expression:)` lookups.
+    Anything the loader cannot provide is left to the REST calls it replaces.
+    """
+
+    def __init__(self, github: AsyncGitHub, commenter: Commenter):
+        self.github = github
+        self.commenter = commenter
+        self.owner, self.name = github.repo.full_name.split("/", 1)
+        self.body: Optional[str] = None
+
+    async def query(self, query: str, variables: Dict[str, Any]) -> Dict[str, Any]:
+        # Requester.graphql_query of the pinned PyGithub nests the variables under `input`, the query is posted as is
+        requester = get_requester(self.github.repo)
+        _, response = await self.github.run(
+            requester.requestJsonAndCheck, "POST", requester.graphql_url,
+            input={"query": query, "variables": variables}
+        )
+        if response.get("errors"):
+            raise Exception(response["errors"][0].get("message", response["errors"]))
+        return response["data"]
+
+    async def load(self, pull_number: int) -> bool:
+        variables = {
+            "owner": self.owner, "name": self.name, "number": pull_number,
+            "commits": None, "comments": None, "threads": None,
+            "withCommits": True, "withComments": True, "withThreads": True,
+        }
+        commit_ids: List[str] = []
+        comments: List[Dict[str, Any]] = []
+        review_comments: List[Dict[str, Any]] = []
+        threads_complete = True
+
+        try:
+            while variables["withCommits"] or variables["withComments"] or variables["withThreads"]:
+                pull_request = (await self.query(PULL_REQUEST_QUERY, variables))["repository"]["pullRequest"]
+                self.body = pull_request["body"]
+
+                for connection, cursor, flag in [("commits", "commits", "withCommits"),
+                                                 ("comments", "comments", "withComments"),
+                                                 ("reviewThreads", "threads", "withThreads")]:
+                    if not variables[flag]:
+                        continue
+                    page = pull_request[connection]
+                    if connection == "commits":
+                        commit_ids.extend(node["commit"]["oid"] for node in page["nodes"])
+                    elif connection == "comments":
+                        comments.extend(page["nodes"])
+                    else:
+                        for thread in page["nodes"]:
+                            review_comments.extend(thread["comments"]["nodes"])
+                            threads_complete = threads_complete and not thread["comments"]["pageInfo"]["hasNextPage"]
+                    variables[cursor] = page["pageInfo"]["endCursor"]
+                    variables[flag] = page["pageInfo"]["hasNextPage"]
+        except Exception as e:
+            logger.warning(f"Failed to load pull request #{pull_number} through GraphQL: {e}")
+            return False
+
+        self.commenter.commit_ids_cache[pull_number] = commit_ids
+        self.commenter.issue_comments_cache[pull_number] = [self.issue_comment(node) for node in comments]
+        if threads_complete:
+            # the REST listing returns review comments in creation order
+            review_comments.sort(key=lambda node: node["databaseId"])
+            self.commenter.review_comments_cache[pull_number] = ReviewCommentIndex(
+                [self.review_comment(node) for node in review_comments]
+            )
+        else:
+            logger.info("review threads with more than 100 comments are listed through REST")
+
+        logger.info(f"loaded pull request #{pull_number}: {len(commit_ids)} commits, {len(comments)} comments, "
+                    f"{len(review_comments)} review comments")
+        return True
+
+    def issue_comment(self, node: Dict[str, Any]) -> IssueComment:
+        return IssueComment(get_requester(self.github.repo), {}, {
+            "id": node["databaseId"],
+            "body": node["body"],
+            "created_at": node["createdAt"],
+            "html_url": node["url"],
+            "url": f"{self.github.repo.url}/issues/comments/{node['databaseId']}",
+            "user": {"login": node["author"]["login"] if node["author"] else ""},
+        }, completed=True)
+
+    def review_comment(self, node: Dict[str, Any]) -> PullRequestComment:
+        return PullRequestComment(get_requester(self.github.repo), {}, {
+            "id": node["databaseId"],
+            "body": node["body"],
+            "created_at": node["createdAt"],
+            "html_url": node["url"],
+            "url": f"{self.github.repo.url}/pulls/comments/{node['databaseId']}",
+            "path": node["path"],
+            "line": node["line"],
+            "start_line": node["startLine"],
+            "original_line": node["originalLine"],
+            "original_start_line": node["originalStartLine"],
+            "diff_hunk": node["diffHunk"],
+            "in_reply_to_id": node["replyTo"]["databaseId"] if node["replyTo"] else None,
+            "user": {"login": node["author"]["login"] if node["author"] else ""},
+        }, completed=True)
+
+    async def load_blobs(self, ref: str, paths: List[str]) -> Dict[str, str]:
+        """Text of the files at `ref`. New and binary files map to "", files that could not be loaded are left out."""
+        batches = [paths[i:i + BLOBS_PER_QUERY] for i in range(0, len(paths), BLOBS_PER_QUERY)]
+        blobs: Dict[str, str] = {}
+        for result in await asyncio.gather(*[self.load_blob_batch(ref, batch) for batch in batches]):
+            blobs.update(result)
+        return blobs
+
+    async def load_blob_batch(self, ref: str, paths: List[str]) -> Dict[str, str]:
+        declarations = "".join(f", $e{i}: String!" for i in range(len(paths)))
+        fields = "".join(f" f{i}: object(expression: $e{i}) {{ ... on Blob {{ text isBinary }} }}"
+                         for i in range(len(paths)))
+        query = (f"query($owner: String!, $name: String!{declarations}) "
+                 f"{{ repository(owner: $owner, name: $name) {{{fields} }} }}")
+        variables = {"owner": self.owner, "name": self.name}
+        variables.update({f"e{i}": f"{ref}:{path}" for i, path in enumerate(paths)})
+
+        try:
+            repository = (await self.query(query, variables))["repository"]
+        except Exception as e:
+            logger.warning(f"Failed to load file contents through GraphQL: {e}")
+            return {}
+
+        blobs = {}
+        for i, path in enumerate(paths):
+            blob = repository.get(f"f{i}")
+            if blob is None or blob.get("isBinary"):
+                blobs[path] = ""
+            elif blob.get("text") is not None:
+                blobs[path] = blob["text"]
+        return blobs
@@ -0,0 +1,79 @@
+import re
+import threading
+from typing import Any, Dict, Optional, Tuple
+from app.cache import ResultCache
+from app.logger import setup_logger
+
+logger = setup_logger("http_cache")
+
+# list endpoints re-read on every run: review comments, issue comments, commits, reviews and files of a pull request
+CONDITIONAL_URL_PATTERN = re.compile(r"/(pulls|issues)/\d+/(comments|commits|reviews|files)(\?|$)")
+
+
+class ConditionalRequestCache:
+    """Sends conditional GET requests for GitHub list endpoints.
+
+    The ETag and Last-Modified validators of every page are stored on disk together with the page itself.
+    The next request for that page carries If-None-Match / If-Modified-Since, and an unchanged page comes
+    back as 304 Not Modified, which GitHub does not count against the rate limit; the stored page is
+    served instead. Point `directory` at the same actions/cache directory as the result caches.
+    """
+
+    def __init__(self, directory: str):
+        self.store = ResultCache(directory, "http")
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.not_modified = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.store.enabled
+
+    def install(self, requester):
+        """Wrap `requester.requestJson`, which every PyGithub GET (including pagination) goes through."""
+        request_json = requester.requestJson
+
+        def conditional_request_json(verb: str, url: str, parameters: Optional[Dict[str, Any]] = None,
+                                     headers: Optional[Dict[str, Any]] = None, *args, **kwargs):
+            if verb != "GET" or not CONDITIONAL_URL_PATTERN.search(url):
+                return request_json(verb, url, parameters, headers, *args, **kwargs)
+            return self.request(request_json, url, parameters, headers, *args, **kwargs)
+
+        requester.requestJson = conditional_request_json
+
+    def request(self, request_json, url: str, parameters: Optional[Dict[str, Any]],
+                headers: Optional[Dict[str, Any]], *args, **kwargs) -> Tuple[int, Dict[str, Any], str]:
+        key = ResultCache.key(url, *[f"{name}={value}" for name, value in sorted((parameters or {}).items())])
+        entry = self.store.get(key)
+
+        headers = dict(headers or {})
+        if entry:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        status, response_headers, output = request_json("GET", url, parameters, headers, *args, **kwargs)
+
+        with self.lock:
+            self.requests += 1
+            if status == 304 and entry:
+                self.not_modified += 1
+
+        if status == 304 and entry:
+            logger.debug(f"not modified: {url}")
+            # keep the fresh rate limit headers, the rest (pagination links included) describe the stored page
+            return 200, {**entry["headers"], **response_headers}, entry["output"]
+
+        if status == 200 and ("etag" in response_headers or "last-modified" in response_headers):
+            self.store.set(key, {
+                "etag": response_headers.get("etag"),
+                "last_modified": response_headers.get("last-modified"),
+                "headers": response_headers,
+                "output": output,
+            })
+        return status, response_headers, output
+
+    def stats(self) -> str:
+        hit_rate = self.not_modified / self.requests if self.requests else 0.0
+        return f"conditional requests: {self.requests}, not modified: {self.not_modified}, hit rate: {hit_rate:.0%}"
@@ -1,3 +1,6 @@
+from app.template import compile_template
+
+
 class Inputs:
     def __init__(
         self,
@@ -47,17 +50,4 @@ class Inputs:
         if not content:
             return ""
 
-        content = content.replace("$system_message", self.system_message)
-        content = content.replace("$title", self.title)
-        content = content.replace("$description", self.description)
-        content = content.replace("$raw_summary", self.raw_summary)
-        content = content.replace("$short_summary", self.short_summary)
-        content = content.replace("$filename", self.filename)
-        content = content.replace("$file_content", self.file_content)
-        content = content.replace("$file_diff", self.file_diff)
-        content = content.replace("$patches", self.patches)
-        content = content.replace("$diff", self.diff)
-        content = content.replace("$comment_chain", self.comment_chain)
-        content = content.replace("$comment", self.comment)
-
-        return content
\ No newline at end of file
+        return compile_template(content).render(self)
@@ -8,10 +8,10 @@ class TokenLimits:
         elif model == "gpt-3.5-turbo-16k":
             self.max_tokens = 16300
             self.response_tokens = 3000
-        elif any(substring in model for substring in ["gpt-4", "mixtral", "llama-3"]):
+        elif any(substring in model for substring in ["gpt-4", "llama-3"]):
             self.max_tokens = 8000
             self.response_tokens = 2000
-        elif model in ["mistral-tiny", "mistral-small", "mistral-medium"]:
+        elif "mixtral" in model or model in ["mistral-tiny", "mistral-small", "mistral-medium"]:
             self.max_tokens = 32000
             self.response_tokens = 4000
         else:
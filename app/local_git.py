@@ -0,0 +1,197 @@
+import os
+import shutil
+import asyncio
+from typing import Dict, List, Optional, Tuple
+from app.logger import setup_logger
+
+logger = setup_logger("local_git")
+
+# single-letter statuses of `git diff --raw` mapped to the statuses of the GitHub compare API
+STATUSES = {"A": "added", "D": "removed", "M": "modified", "R": "renamed", "C": "copied", "T": "changed"}
+
+
+class LocalFile:
+    """The attributes of a GitHub compare `File` that the review reads, computed from a local clone."""
+
+    def __init__(self, filename: str, status: str, sha: str, patch: Optional[str],
+                 previous_filename: Optional[str] = None):
+        self.filename = filename
+        self.status = status
+        self.sha = sha
+        self.patch = patch
+        self.previous_filename = previous_filename
+
+
+class LocalCommit:
+    def __init__(self, sha: str):
+        self.sha = sha
+
+
+class LocalComparison:
+    def __init__(self, files: List[LocalFile], commits: List[LocalCommit]):
+        self.files = files
+        self.commits = commits
+
+
+class LocalGit:
+    """Diffs and file contents read from a local clone with `git`, instead of the GitHub API.
+
+    Unlike the compare API, `git diff` neither stops at 300 files nor drops the patch of large files. Commits
+    missing from the clone are fetched from `origin`; computing the merge base needs their history, so check
+    out with `fetch-depth: 0`. Every method returns None when the clone cannot answer, and the caller falls
+    back to the API. The distroless action image has no `git`, so this is not an action input: runs of
+    `app/main.py` outside of the image enable it by setting `SEINE_SAILOR_LOCAL_GIT_DIR` to the clone.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.lock = asyncio.Lock()
+        self.cat_file: Optional[asyncio.subprocess.Process] = None
+
+    @classmethod
+    async def open(cls, directory: str) -> Optional["LocalGit"]:
+        if not directory:
+            return None
+        if not shutil.which("git"):
+            logger.warning("git is not installed (the action image does not include it), "
+                           "diffs are fetched from the GitHub API")
+            return None
+        if not os.path.isdir(directory):
+            logger.warning(f"{directory} does not exist, diffs are fetched from the GitHub API")
+            return None
+
+        local = cls(directory)
+        status, _ = await local.git("rev-parse", "--git-dir")
+        if status != 0:
+            logger.warning(f"{directory} is not a git repository, diffs are fetched from the GitHub API")
+            return None
+        return local
+
+    async def git(self, *args: str) -> Tuple[int, bytes]:
+        # the checkout belongs to the runner user, not to the container user
+        process = await asyncio.create_subprocess_exec(
+            "git", "-c", "safe.directory=*", "-c", "core.quotePath=false", *args,
+            cwd=self.directory,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+        if process.returncode != 0:
+            logger.debug(f"git {' '.join(args)} failed: {stderr.decode('utf-8', errors='replace').strip()}")
+        return process.returncode, stdout
+
+    async def ensure_commits(self, *shas: str) -> bool:
+        missing = [sha for sha in shas if (await self.git("cat-file", "-e", f"{sha}^{{commit}}"))[0] != 0]
+        if missing:
+            logger.info(f"fetching {', '.join(missing)} from origin")
+            status, _ = await self.git("fetch", "--no-tags", "origin", *missing)
+            if status != 0:
+                return False
+        return True
+
+    async def compare(self, base: str, head: str) -> Optional[LocalComparison]:
+        """The files and commits of `base...head`, like the GitHub compare API."""
+        if not await self.ensure_commits(base, head):
+            return None
+        status, output = await self.git("merge-base", base, head)
+        if status != 0:
+            logger.info(f"no merge base of {base} and {head} in the clone, is it shallow?")
+            return None
+        merge_base = output.decode().strip()
+
+        (raw_status, raw), (patch_status, patches), (log_status, log) = await asyncio.gather(
+            self.git("diff", "--raw", "-z", "--full-index", "-M", merge_base, head),
+            self.git("diff", "--no-color", "--no-ext-diff", "--full-index", "-M", merge_base, head),
+            self.git("rev-list", "--reverse", f"{merge_base}..{head}")
+        )
+        if raw_status != 0 or patch_status != 0 or log_status != 0:
+            return None
+
+        entries = parse_raw_diff(raw.decode("utf-8", errors="replace"))
+        sections = split_diff_sections(patches.decode("utf-8", errors="replace"))
+        if len(entries) != len(sections):
+            logger.warning(f"git diff listed {len(entries)} files but printed {len(sections)} patches")
+            return None
+
+        files = [
+            LocalFile(filename, STATUSES.get(status[0], "modified"), sha, section_patch(section), previous_filename)
+            for (status, sha, filename, previous_filename), section in zip(entries, sections)
+        ]
+        commits = [LocalCommit(sha) for sha in log.decode().split()]
+        return LocalComparison(files, commits)
+
+    async def get_tree(self, ref: str) -> Optional[Dict[str, str]]:
+        """Path to blob SHA for every file at `ref`."""
+        if not await self.ensure_commits(ref):
+            return None
+        status, output = await self.git("ls-tree", "-r", "-z", "--full-tree", ref)
+        if status != 0:
+            return None
+        tree = {}
+        for entry in output.decode("utf-8", errors="replace").split("\0"):
+            if not entry:
+                continue
+            info, path = entry.split("\t", 1)
+            _, kind, sha = info.split()
+            if kind == "blob":
+                tree[path] = sha
+        return tree
+
+    async def read_blob(self, sha: str) -> Optional[bytes]:
+        """Blob contents through one long-running `git cat-file --batch` process."""
+        async with self.lock:
+            if self.cat_file is None or self.cat_file.returncode is not None:
+                self.cat_file = await asyncio.create_subprocess_exec(
+                    "git", "-c", "safe.directory=*", "cat-file", "--batch",
+                    cwd=self.directory,
+                    stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.DEVNULL
+                )
+            self.cat_file.stdin.write(f"{sha}\n".encode())
+            await self.cat_file.stdin.drain()
+            header = (await self.cat_file.stdout.readline()).decode().split()
+            if len(header) != 3:
+                return None
+            data = await self.cat_file.stdout.readexactly(int(header[2]) + 1)
+            return data[:-1]
+
+    async def close(self):
+        if self.cat_file and self.cat_file.returncode is None:
+            self.cat_file.stdin.close()
+            await self.cat_file.wait()
+
+
+def parse_raw_diff(raw: str) -> List[Tuple[str, str, str, Optional[str]]]:
+    """(status, new blob SHA, path, previous path) for every entry of `git diff --raw -z`."""
+    fields = raw.split("\0")
+    entries = []
+    i = 0
+    while i < len(fields) and fields[i]:
+        _, _, _, new_sha, status = fields[i].lstrip(":").split()
+        if status[0] in "RC":
+            entries.append((status, new_sha, fields[i + 2], fields[i + 1]))
+            i += 3
+        else:
+            entries.append((status, new_sha, fields[i + 1], None))
+            i += 2
+    return entries
+
+
+def split_diff_sections(diff: str) -> List[str]:
+    sections: List[List[str]] = []
+    for line in diff.splitlines(keepends=True):
+        if line.startswith("diff --git "):
+            sections.append([line])
+        elif sections:
+            sections[-1].append(line)
+    return ["".join(lines) for lines in sections]
+
+
+def section_patch(section: str) -> Optional[str]:
+    """The hunks of one file, the way the compare API returns them in `patch`; None for binary files."""
+    start = section.find("\n@@")
+    if start < 0:
+        return None
+    return section[start + 1:].rstrip("\n")
@@ -13,6 +13,7 @@ async def main():
         max_files=os.environ.get("INPUT_MAX_FILES", "0"),
         review_simple_changes=os.environ.get("INPUT_REVIEW_SIMPLE_CHANGES", False),
         review_comment_lgtm=os.environ.get("INPUT_REVIEW_COMMENT_LGTM", False),
+        review_batch_file_tokens=os.environ.get("INPUT_REVIEW_BATCH_FILE_TOKENS", "300"),
         path_filters=os.environ.get("INPUT_PATH_FILTERS", "").split("\n") if os.environ.get(
             "INPUT_PATH_FILTERS") else None,
         system_message=os.environ.get("INPUT_SYSTEM_MESSAGE", ""),
@@ -22,10 +23,17 @@ async def main():
         llm_retries=os.environ.get("INPUT_LLM_RETRIES", "3"),
         llm_timeout_ms=os.environ.get("INPUT_LLM_TIMEOUT_MS", "120000"),
         llm_concurrency_limit=os.environ.get("INPUT_LLM_CONCURRENCY_LIMIT", "6"),
+        llm_max_concurrency_limit=os.environ.get("INPUT_LLM_MAX_CONCURRENCY_LIMIT", "24"),
+        llm_tokens_per_minute=os.environ.get("INPUT_LLM_TOKENS_PER_MINUTE", "0"),
+        llm_requests_per_minute=os.environ.get("INPUT_LLM_REQUESTS_PER_MINUTE", "0"),
         github_concurrency_limit=os.environ.get("INPUT_GITHUB_CONCURRENCY_LIMIT", "6"),
+        github_graphql=os.environ.get("INPUT_GITHUB_GRAPHQL", "false"),
+        # not an action input: the action image has no git, see LocalGit
+        local_git_dir=os.environ.get("SEINE_SAILOR_LOCAL_GIT_DIR", ""),
         api_base_url=os.environ.get("INPUT_LLM_BASE_URL", "https://us-south.ml.cloud.ibm.com"),
         language=os.environ.get("INPUT_LANGUAGE", "en-US"),
-        api_type=os.environ.get("INPUT_LLM_API_TYPE", "watsonx")
+        api_type=os.environ.get("INPUT_LLM_API_TYPE", "watsonx"),
+        cache_dir=os.environ.get("INPUT_CACHE_DIR", "")
     )
 
     if options.debug:
@@ -35,25 +43,28 @@ async def main():
     logger = setup_logger("main")
 
     from app.prompts import Prompts
-    from app.bot import Bot
+    from app.bot import Bot, TokenBudget
     from app.review import code_review
     from app.review_comment import handle_review_comment
     from app.issue_comment import handle_issue_comment
-    from app.context import context
+    from app.context import context, http_cache
 
     prompts = Prompts(
         summarize=os.environ.get("INPUT_SUMMARIZE", ""),
         summarize_release_notes=os.environ.get("INPUT_SUMMARIZE_RELEASE_NOTES", "")
     )
 
+    # both models usually draw from the same provider quota
+    budget = TokenBudget(options.llm_tokens_per_minute, options.llm_requests_per_minute)
+
     try:
-        light_bot = Bot(options, LLMOptions(options.llm_light_model, options.light_token_limits))
+        light_bot = Bot(options, LLMOptions(options.llm_light_model, options.light_token_limits), budget)
     except Exception as e:
         print(f"Skipped: failed to create summary bot, please check your openai_api_key: {e}")
         return
 
     try:
-        heavy_bot = Bot(options, LLMOptions(options.llm_heavy_model, options.heavy_token_limits))
+        heavy_bot = Bot(options, LLMOptions(options.llm_heavy_model, options.heavy_token_limits), budget)
     except Exception as e:
         print(f"Skipped: failed to create review bot, please check your openai_api_key: {e}")
         return
@@ -70,6 +81,9 @@ async def main():
     except Exception as e:
         print(f"Failed to run: {e}")
 
+    if http_cache.enabled:
+        logger.debug(f"GitHub {http_cache.stats()}")
+
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -54,6 +54,7 @@ class Options:
             max_files: str = "0",
             review_simple_changes: bool = False,
             review_comment_lgtm: bool = False,
+            review_batch_file_tokens: str = "300",
             path_filters: List[str] = None,
             system_message: str = "",
             llm_light_model: str = "mistralai/mixtral-8x7b-instruct-v01",
@@ -62,10 +63,16 @@ class Options:
             llm_retries: str = "3",
             llm_timeout_ms: str = "120000",
             llm_concurrency_limit: str = "6",
+            llm_max_concurrency_limit: str = "24",
+            llm_tokens_per_minute: str = "0",
+            llm_requests_per_minute: str = "0",
             github_concurrency_limit: str = "6",
+            github_graphql: str = "false",
+            local_git_dir: str = "",
             api_base_url: str = "https://us-south.ml.cloud.ibm.com",
             language: str = "en-US",
-            api_type: str = "watsonx"
+            api_type: str = "watsonx",
+            cache_dir: str = ""
     ):
         self.debug = debug
         self.disable_review = disable_review
@@ -73,6 +80,7 @@ class Options:
         self.max_files = int(max_files)
         self.review_simple_changes = review_simple_changes
         self.review_comment_lgtm = review_comment_lgtm
+        self.review_batch_file_tokens = int(review_batch_file_tokens)
         self.path_filters = PathFilter(path_filters)
         self.system_message = system_message
         self.llm_light_model = llm_light_model
@@ -81,12 +89,18 @@ class Options:
         self.llm_retries = int(llm_retries)
         self.llm_timeout_ms = int(llm_timeout_ms)
         self.llm_concurrency_limit = int(llm_concurrency_limit)
+        self.llm_max_concurrency_limit = max(int(llm_max_concurrency_limit), self.llm_concurrency_limit)
+        self.llm_tokens_per_minute = int(llm_tokens_per_minute)
+        self.llm_requests_per_minute = int(llm_requests_per_minute)
         self.github_concurrency_limit = int(github_concurrency_limit)
+        self.github_graphql = str(github_graphql).lower() == "true"
+        self.local_git_dir = local_git_dir
         self.light_token_limits = TokenLimits(llm_light_model)
         self.heavy_token_limits = TokenLimits(llm_heavy_model)
         self.api_base_url = api_base_url
         self.language = language
         self.api_type = api_type
+        self.cache_dir = cache_dir
 
     def print(self):
         logger.info(
@@ -97,6 +111,7 @@ class Options:
             f"  max_files={self.max_files}\n"
             f"  review_simple_changes={self.review_simple_changes}\n"
             f"  review_comment_lgtm={self.review_comment_lgtm}\n"
+            f"  review_batch_file_tokens={self.review_batch_file_tokens}\n"
             f"  path_filters={self.path_filters}\n"
             f"  system_message={self.system_message}\n"
             f"  llm_light_model={self.llm_light_model}\n"
@@ -105,11 +120,17 @@ class Options:
             f"  llm_retries={self.llm_retries}\n"
             f"  llm_timeout_ms={self.llm_timeout_ms}\n"
             f"  llm_concurrency_limit={self.llm_concurrency_limit}\n"
+            f"  llm_max_concurrency_limit={self.llm_max_concurrency_limit}\n"
+            f"  llm_tokens_per_minute={self.llm_tokens_per_minute}\n"
+            f"  llm_requests_per_minute={self.llm_requests_per_minute}\n"
             f"  github_concurrency_limit={self.github_concurrency_limit}\n"
+            f"  github_graphql={self.github_graphql}\n"
+            f"  local_git_dir={self.local_git_dir}\n"
             f"  summary_token_limits={self.light_token_limits.string()}\n"
             f"  review_token_limits={self.heavy_token_limits.string()}\n"
             f"  api_base_url={self.api_base_url}\n"
-            f"  language={self.language}"
+            f"  language={self.language}\n"
+            f"  cache_dir={self.cache_dir}"
         )
 
     def check_path(self, path: str) -> bool:
@@ -0,0 +1,128 @@
+import time
+import asyncio
+from typing import Any, AsyncIterable, Awaitable, Callable, Dict, Iterable, List, Optional, Union
+from app.logger import setup_logger
+
+logger = setup_logger("pipeline")
+
+_DONE = object()
+
+
+class Stage:
+    def __init__(self, name: str, fn: Callable[[Any], Awaitable[Any]], concurrency: int = 1, queue_size: int = 0,
+                 on_error: Optional[Callable[[Any, Exception], None]] = None):
+        self.name = name
+        self.fn = fn
+        self.concurrency = max(1, concurrency)
+        self.queue_size = queue_size
+        self.on_error = on_error
+        self.queue: Optional[asyncio.Queue] = None
+        self.done = asyncio.Event()
+        self.processed = 0
+        self.busy_time = 0.0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    def timing(self) -> str:
+        wall_time = (self.finished_at - self.started_at) if self.started_at and self.finished_at else 0.0
+        return (f"{self.name}: {self.processed} items, busy {self.busy_time:.2f}s, "
+                f"wall {wall_time:.2f}s, concurrency {self.concurrency}")
+
+
+class Pipeline:
+    """Streams items through a chain of asyncio stages connected by queues.
+
+    Every stage runs `concurrency` workers. A stage function returns the item to hand to the next stage, or None
+    to drop it, so each item flows through the stages independently of the others: the first file can be
+    reviewed while a slow one is still being summarized. Results of the last stage are returned by `run`.
+
+    A stage with a `queue_size` holds at most that many items waiting for it, and the stages before it (down to
+    the source of the items) wait for room, so only the items in flight are kept in memory. Leave the queue of a
+    stage unbounded when its workers can wait for something the earlier stages have to finish first.
+    An exception raised by a stage function drops the item and is handed to the stage's `on_error`.
+    """
+
+    def __init__(self, name: str, label: Callable[[Any], str] = str):
+        self.name = name
+        self.label = label
+        self.stages: List[Stage] = []
+        self.stages_by_name: Dict[str, Stage] = {}
+
+    def add_stage(self, name: str, fn: Callable[[Any], Awaitable[Any]], concurrency: int = 1, queue_size: int = 0,
+                  on_error: Optional[Callable[[Any, Exception], None]] = None) -> "Pipeline":
+        stage = Stage(name, fn, concurrency, queue_size, on_error)
+        self.stages.append(stage)
+        self.stages_by_name[name] = stage
+        return self
+
+    async def wait_for_stage(self, name: str):
+        """Wait until every item has left the given stage."""
+        await self.stages_by_name[name].done.wait()
+
+    async def run(self, items: Union[Iterable, AsyncIterable]) -> List[Any]:
+        results = []
+        if not self.stages:
+            return results
+
+        for stage in self.stages:
+            stage.queue = asyncio.Queue(stage.queue_size)
+
+        async def feed():
+            first = self.stages[0]
+            try:
+                if hasattr(items, "__aiter__"):
+                    async for item in items:
+                        await first.queue.put(item)
+                else:
+                    for item in items:
+                        await first.queue.put(item)
+            finally:
+                for _ in range(first.concurrency):
+                    await first.queue.put(_DONE)
+
+        async def work(stage: Stage, next_stage: Optional[Stage]):
+            while True:
+                item = await stage.queue.get()
+                if item is _DONE:
+                    return
+
+                start = time.monotonic()
+                if stage.started_at is None:
+                    stage.started_at = start
+                try:
+                    result = await stage.fn(item)
+                except Exception as e:
+                    logger.warning(f"{self.name}: {stage.name} failed for {self.label(item)}: {e}")
+                    if stage.on_error:
+                        stage.on_error(item, e)
+                    result = None
+                elapsed = time.monotonic() - start
+                stage.busy_time += elapsed
+                stage.processed += 1
+                logger.debug(f"{self.name}: {stage.name} {self.label(item)} took {elapsed:.2f}s")
+
+                if result is None:
+                    continue
+                if next_stage:
+                    await next_stage.queue.put(result)
+                else:
+                    results.append(result)
+
+        async def run_stage(index: int):
+            stage = self.stages[index]
+            next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+            try:
+                await asyncio.gather(*[work(stage, next_stage) for _ in range(stage.concurrency)])
+            finally:
+                stage.finished_at = time.monotonic()
+                stage.done.set()
+                if next_stage:
+                    for _ in range(next_stage.concurrency):
+                        await next_stage.queue.put(_DONE)
+
+        await asyncio.gather(feed(), *[run_stage(index) for index in range(len(self.stages))])
+
+        for stage in self.stages:
+            logger.debug(f"{self.name}: {stage.timing()}")
+
+        return results
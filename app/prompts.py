@@ -1,4 +1,6 @@
+from typing import Dict, List
 from app.inputs import Inputs
+from app.template import CompiledTemplate, compile_template
 
 
 class Prompts:
@@ -52,6 +54,36 @@ Important:
 - Do not mention that these changes affect the logic or functionality of the code in 
   the summary. You must only use the triage status format above to indicate that."""
 
+    triage_file_diffs = """## GitHub PR Title
+
+`$title` 
+
+## Description
+
+```
+$description
+```
+
+## Diffs
+
+$patches
+
+## Instructions
+
+Each diff above starts with a line `FILE: <filename>`. I would like you to triage every 
+diff as `NEEDS_REVIEW` or `APPROVED` based on the following criteria:
+
+- If the diff involves any modifications to the logic or functionality, even if they 
+  seem minor, triage it as `NEEDS_REVIEW`. This includes changes to control structures, 
+  function calls, or variable assignments that might impact the behavior of the code.
+- If the diff only contains very minor changes that don't affect the code logic, such as 
+  fixing typos, formatting, or renaming variables for clarity, triage it as `APPROVED`.
+
+When in doubt, always err on the side of caution and triage the diff as `NEEDS_REVIEW`.
+
+You must strictly follow the format below, with exactly one line per file and nothing else:
+FILE: <filename> [TRIAGE]: <NEEDS_REVIEW or APPROVED>"""
+
     summarize_changesets = """
 Provided below are changesets in this pull request. Changesets 
 are in chronological order and new changesets are appended to the
@@ -82,7 +114,7 @@ Instructions:
 - Do not mention that these changes affect the logic or functionality of the code.
 - The summary should not exceed 500 words."""
 
-    review_file_diff = """## GitHub PR Title
+    review_instructions = """## GitHub PR Title
 
 `$title` 
 
@@ -172,7 +204,19 @@ There's a syntax error in the add function.
 LGTM!
 ---
 
-## Changes made to `$filename` for your review
+"""
+
+    review_file_diff = review_instructions + """## Changes made to `$filename` for your review
+
+$patches"""
+
+    review_files_batch = review_instructions + """## Reviewing several files
+
+The changes below belong to several files. The changes of each file start with a line 
+`FILE: <filename>` and their line numbers refer to that file. In your response, write the 
+same `FILE: <filename>` line before the review comments for each file, and review every file.
+
+## Changes made to several files for your review
 
 $patches"""
 
@@ -239,30 +283,87 @@ $comment
     def __init__(self, summarize="", summarize_release_notes=""):
         self.summarize = summarize
         self.summarize_release_notes = summarize_release_notes
+        self.compiled_templates: Dict[str, CompiledTemplate] = {}
+        for template in [
+            self.summarize_file_diff_template(True),
+            self.summarize_file_diff_template(False),
+            self.triage_file_diffs,
+            self.summarize_changesets,
+            self.summarize_prefix + self.summarize,
+            self.summarize_prefix + self.summarize_short,
+            self.summarize_prefix + self.summarize_release_notes,
+            self.comment,
+            self.review_file_diff,
+            self.review_files_batch,
+        ]:
+            self.compiled_templates[template] = compile_template(template)
+
+    def compile(self, template: str) -> CompiledTemplate:
+        if template not in self.compiled_templates:
+            self.compiled_templates[template] = compile_template(template)
+        return self.compiled_templates[template]
+
+    def file_templates(self) -> List[str]:
+        """Templates rendered once per file, with `$filename`, `$file_content` and `$file_diff` set."""
+        return [
+            self.summarize_file_diff_template(True),
+            self.summarize_file_diff_template(False),
+            self.review_file_diff,
+            self.review_files_batch,
+        ]
+
+    def file_templates_use(self, variable: str) -> bool:
+        return any(self.compile(template).uses(variable) for template in self.file_templates())
+
+    def summarize_file_diff_template(self, review_simple_changes: bool) -> str:
+        if review_simple_changes:
+            return self.summarize_file_diff
+        return self.summarize_file_diff + self.triage_file_diff
+
+    def count_summarize_file_diff(self, inputs: Inputs, review_simple_changes: bool, model: str = "") -> int:
+        return self.compile(self.summarize_file_diff_template(review_simple_changes)).count_tokens(inputs, model)
+
+    def count_triage_file_diffs(self, inputs: Inputs, model: str = "") -> int:
+        return self.compile(self.triage_file_diffs).count_tokens(inputs, model)
+
+    def count_summarize_changesets(self, inputs: Inputs, model: str = "") -> int:
+        return self.compile(self.summarize_changesets).count_tokens(inputs, model)
+
+    def count_comment(self, inputs: Inputs, model: str = "") -> int:
+        return self.compile(self.comment).count_tokens(inputs, model)
+
+    def count_review_file_diff(self, inputs: Inputs, model: str = "") -> int:
+        return self.compile(self.review_file_diff).count_tokens(inputs, model)
+
+    def count_review_files_batch(self, inputs: Inputs, model: str = "") -> int:
+        return self.compile(self.review_files_batch).count_tokens(inputs, model)
 
     def render_summarize_file_diff(self, inputs: Inputs, review_simple_changes: bool) -> str:
-        prompt = self.summarize_file_diff
-        if not review_simple_changes:
-            prompt += self.triage_file_diff
-        return inputs.render(prompt)
+        return self.compile(self.summarize_file_diff_template(review_simple_changes)).render(inputs)
+
+    def render_triage_file_diffs(self, inputs: Inputs) -> str:
+        return self.compile(self.triage_file_diffs).render(inputs)
 
     def render_summarize_changesets(self, inputs: Inputs) -> str:
-        return inputs.render(self.summarize_changesets)
+        return self.compile(self.summarize_changesets).render(inputs)
 
     def render_summarize(self, inputs: Inputs) -> str:
         prompt = self.summarize_prefix + self.summarize
-        return inputs.render(prompt)
+        return self.compile(prompt).render(inputs)
 
     def render_summarize_short(self, inputs: Inputs) -> str:
         prompt = self.summarize_prefix + self.summarize_short
-        return inputs.render(prompt)
+        return self.compile(prompt).render(inputs)
 
     def render_summarize_release_notes(self, inputs: Inputs) -> str:
         prompt = self.summarize_prefix + self.summarize_release_notes
-        return inputs.render(prompt)
+        return self.compile(prompt).render(inputs)
 
     def render_comment(self, inputs: Inputs) -> str:
-        return inputs.render(self.comment)
+        return self.compile(self.comment).render(inputs)
 
     def render_review_file_diff(self, inputs: Inputs) -> str:
-        return inputs.render(self.review_file_diff)
+        return self.compile(self.review_file_diff).render(inputs)
+
+    def render_review_files_batch(self, inputs: Inputs) -> str:
+        return self.compile(self.review_files_batch).render(inputs)
@@ -1,5 +1,4 @@
 import re
-import base64
 import asyncio
 from typing import List, Tuple, Optional, Dict
 from app.options import Options
@@ -8,17 +7,27 @@ from app.commenter import COMMENT_REPLY_TAG, RAW_SUMMARY_END_TAG, RAW_SUMMARY_ST
     SHORT_SUMMARY_START_TAG, SUMMARIZE_TAG
 from app.inputs import Inputs
 from app.tokenizer import get_token_count
-from app.bot import Bot
-from app.context import commenter, context, ignore_keyword, repo
+from app.bot import Bot, PRIORITY_LOW
+from app.cache import ResultCache
+from app.pipeline import Pipeline
+from app.diff import DiffSnapshot, PullRequestFiles, PULL_FILES_LIMIT
+from app.local_git import LocalGit
+from app.blobs import BlobStore, decode_file_content, truncate_file_content
+from app.graphql_loader import PullRequestLoader
+from app.context import commenter, context, github, ignore_keyword
 from app.logger import setup_logger
 
 logger = setup_logger("review")
 
+# upper bound for the number of small files reviewed in one request
+MAX_FILES_PER_BATCH = 20
+# upper bound for the number of files triaged in one request
+MAX_FILES_PER_TRIAGE = 30
+# base file contents are cut to this many bytes before they are put in a prompt
+MAX_FILE_CONTENT_BYTES = 64 * 1024
 
-async def code_review(light_bot: Bot, heavy_bot: Bot, options: Options, prompts: Prompts):
-    llm_concurrency_limit = asyncio.Semaphore(options.llm_concurrency_limit)
-    github_concurrency_limit = asyncio.Semaphore(options.github_concurrency_limit)
 
+async def code_review(light_bot: Bot, heavy_bot: Bot, options: Options, prompts: Prompts):
     if context["event_name"] not in ["pull_request", "pull_request_target"]:
         logger.warning(f"Skipped: current event is {context['event_name']}, only support pull_request event")
         return
@@ -40,6 +49,15 @@ async def code_review(light_bot: Bot, heavy_bot: Bot, options: Options, prompts:
 
     inputs.system_message = options.system_message
 
+    loader: Optional[PullRequestLoader] = None
+    if options.github_graphql:
+        loader = PullRequestLoader(github, commenter)
+        if not await loader.load(pr_data["number"]):
+            loader = None
+        elif loader.body:
+            # the event payload holds the description as it was when the event fired
+            inputs.description = commenter.get_description(loader.body)
+
     existing_summarize_cmt = await commenter.find_comment_with_tag(SUMMARIZE_TAG, pr_data["number"])
     existing_commit_ids_block = ""
     existing_summarize_cmt_body = ""
@@ -63,113 +81,87 @@ async def code_review(light_bot: Bot, heavy_bot: Bot, options: Options, prompts:
     else:
         logger.info(f"Will review from commit: {highest_reviewed_commit_id}")
 
-    incremental_diff = repo.compare(highest_reviewed_commit_id, pr_data["head"]["sha"])
-    target_branch_diff = repo.compare(pr_data["base"]["sha"], pr_data["head"]["sha"])
-
-    incremental_files = incremental_diff.files
-    target_branch_files = target_branch_diff.files
+    local = await LocalGit.open(options.local_git_dir)
+    diff = await DiffSnapshot.fetch(github, pr_data["base"]["sha"], pr_data["head"]["sha"], highest_reviewed_commit_id,
+                                    local)
 
-    if incremental_files is None or target_branch_files is None:
+    if not diff.complete:
         logger.warning("Skipped: files data is missing")
         return
 
-    files = [file for file in target_branch_files if any(
-        incremental_file.filename == file.filename for incremental_file in incremental_files
-    )]
-
-    if not files:
-        logger.warning("Skipped: files is null")
-        return
-
-    filter_selected_files = []
-    filter_ignored_files = []
-    for file in files:
-        if not options.check_path(file.filename):
-            logger.info(f"skip for excluded path: {file.filename}")
-            filter_ignored_files.append(file)
-        else:
-            filter_selected_files.append(file)
-
-    if not filter_selected_files:
-        logger.warning("Skipped: filterSelectedFiles is null")
-        return
-
-    commits = incremental_diff.commits
+    commits = diff.commits
 
     if not commits:
         logger.warning("Skipped: commits is null")
         return
 
-    async def retrieve_file_contents(file: dict) -> Tuple[str, str, str, List[Tuple[int, int, str]]]:
-        file_content_inner = ""
-        async with github_concurrency_limit:
-            try:
-                contents = repo.get_contents(file["filename"], ref=pr_data["base"]["sha"])
-                if contents.type == "file" and contents.content:
-                    file_content_inner = base64.b64decode(contents.content).decode("utf-8")
-            except Exception as e:
-                logger.warning(f"Failed to get file {file['filename']} contents: {e}. This is OK if it's a new file.")
-
-        file_diff_inner = file.get("patch", "")
+    # the compare API stops at 300 files, larger pull requests are listed page by page as they are reviewed
+    streaming = diff.truncated
+    pull_files = PullRequestFiles(github, pr_data["number"]) if streaming else None
+    if streaming:
+        logger.info(f"compare listed {len(diff.files)} files, listing the files of the pull request page by page")
 
-        patches = []
-        for patch in split_patch(file_diff_inner):
-            hunks, patch_lines = parse_patch(patch)
-            if not patch_lines:
+    filter_selected_files = []
+    filter_ignored_files = []
+    skipped_files = []
+    listing_stopped = False
+
+    async def selected_files():
+        nonlocal listing_stopped
+        selected = 0
+        changed_files = pull_files if streaming else diff.changed_files()
+        async for file in as_async_iterable(changed_files):
+            if streaming and not diff.touched(file.filename):
                 continue
-            hunks_str = f"""
----new_hunk---
-'''
-{hunks["new_hunk"]}
-'''
-
----old_hunk---
-'''
-{hunks["old_hunk"]}
-'''
-"""
-            patches.append((patch_lines["new_hunk"]["start_line"], patch_lines["new_hunk"]["end_line"], hunks_str))
-
-        if patches:
-            return file["filename"], file_content_inner, file_diff_inner, patches
-        else:
-            # Return default values for each part of the tuple
-            return file["filename"], file_content_inner, file_diff_inner, []
-
-    async def semaphore_github(file):
-        async with github_concurrency_limit:
-            return await retrieve_file_contents(file)
+            if not options.check_path(file.filename):
+                logger.info(f"skip for excluded path: {file.filename}")
+                filter_ignored_files.append(file.filename)
+                continue
+            if 0 < options.max_files <= selected:
+                skipped_files.append(file.filename)
+                if streaming:
+                    # stop listing, the files after this one are not fetched at all
+                    listing_stopped = True
+                    return
+                continue
+            selected += 1
+            change = FileChange(file.filename, file.patch or "", parse_file_patches(file.patch))
+            filter_selected_files.append(f"{file.filename} ({len(change.patches)})")
+            yield change
 
-    filtered_files = await asyncio.gather(
-        *[
-            semaphore_github({"filename": file.filename, "patch": file.patch})
-            for file in filter_selected_files
-        ]
-    )
+    if streaming:
+        files_to_process = selected_files()
+    else:
+        if not diff.changed_files():
+            logger.warning("Skipped: files is null")
+            return
 
-    files_and_changes = [file for file in filtered_files if file is not None]
+        files_to_process = [file async for file in selected_files()]
 
-    if not files_and_changes:
-        logger.error("Skipped: no files to review")
-        return
+        if not files_to_process:
+            logger.warning("Skipped: filterSelectedFiles is null")
+            return
 
     status_msg = f'''<details>
 <summary>Commits</summary>
 Files that changed from the base of the PR and between {highest_reviewed_commit_id} 
 and {pr_data["head"]["sha"]} commits.
 </details>
-{"" if not files_and_changes else f"""
+{"" if not streaming else """
+This pull request has too many files to list up front, they are listed as they are reviewed.
+"""}
+{"" if not filter_selected_files else f"""
 <details>
-<summary>Files selected ({len(files_and_changes)})</summary>
+<summary>Files selected ({len(filter_selected_files)})</summary>
 
-* {chr(10).join([f"{filename} ({len(patches)})" for filename, _, _, patches in files_and_changes])}
+* {chr(10).join(filter_selected_files)}
 </details>
 """}
 {"" if not filter_ignored_files else f"""
 <details>
 <summary>Files ignored due to filter ({len(filter_ignored_files)})</summary>
 
-* {chr(10).join([file.filename for file in filter_ignored_files])}
+* {chr(10).join(filter_ignored_files)}
 
 </details>
 """}
@@ -179,9 +171,44 @@ and {pr_data["head"]["sha"]} commits.
 
     await commenter.comment(in_progress_summarize_cmt, SUMMARIZE_TAG, "replace", pr_data["number"])
 
+    # the base version of a file is only downloaded when a template shows it to the model
+    file_content_needed = prompts.file_templates_use("file_content")
+
+    base_blobs: Optional[asyncio.Future] = None
+    if loader and file_content_needed and not streaming:
+        base_blobs = asyncio.ensure_future(
+            loader.load_blobs(pr_data["base"]["sha"], [file.filename for file in files_to_process])
+        )
+
+    blob_store = BlobStore(github, options.cache_dir, local)
+
+    async def retrieve_file_contents(file: FileChange) -> FileChange:
+        if base_blobs:
+            blobs = await base_blobs
+            if file.filename in blobs:
+                file.file_content = truncate_file_content(blobs[file.filename], MAX_FILE_CONTENT_BYTES)
+                return file
+        try:
+            content = await blob_store.get_file(pr_data["base"]["sha"], file.filename, MAX_FILE_CONTENT_BYTES)
+            if content is not None:
+                file.file_content = content
+                return file
+        except Exception as e:
+            logger.warning(f"Failed to get file {file.filename} through its blob: {e}")
+        try:
+            contents = await github.get_contents(file.filename, ref=pr_data["base"]["sha"])
+            if contents.type == "file" and contents.content:
+                file.file_content = decode_file_content(contents.content, MAX_FILE_CONTENT_BYTES)
+        except Exception as e:
+            logger.warning(f"Failed to get file {file.filename} contents: {e}. This is OK if it's a new file.")
+        return file
+
+    summaries: List[Tuple[str, str, bool]] = []
     summaries_failed = []
+    summary_cache = ResultCache(options.cache_dir, "summaries")
 
-    async def do_summary(filename: str, file_content_summary: str, file_diff_summary: str) -> Tuple[str, str, bool]:
+    async def do_summary(filename: str, file_content_summary: str, file_diff_summary: str,
+                         triage: bool) -> Tuple[str, str, bool]:
         logger.info(f"summarize: {filename}")
         ins = inputs.clone()
         if not file_diff_summary:
@@ -191,24 +218,35 @@ and {pr_data["head"]["sha"]} commits.
 
         ins.filename = filename
         ins.file_diff = file_diff_summary
+        if file_content_summary:
+            ins.file_content = file_content_summary
 
-        summarize_prompt = prompts.render_summarize_file_diff(ins, options.review_simple_changes)
-        tokens = get_token_count(summarize_prompt)
+        tokens = prompts.count_summarize_file_diff(ins, not triage, options.llm_light_model)
 
         if tokens > options.light_token_limits.request_tokens:
             logger.info(f"summarize: diff tokens exceeds limit, skip {filename}")
             summaries_failed.append(f"{filename} (diff tokens exceeds limit)")
             return filename, "", False
 
+        summarize_prompt = prompts.render_summarize_file_diff(ins, not triage)
+
         try:
-            summarize_response = await light_bot.chat(summarize_prompt)
+            cache_key = ResultCache.key(summarize_prompt, light_bot.llm_options.model,
+                                        str(options.llm_model_temperature))
+            summarize_response = summary_cache.get(cache_key)
+            if summarize_response is None:
+                summarize_response = await light_bot.chat(summarize_prompt)
+                if summarize_response:
+                    summary_cache.set(cache_key, summarize_response)
+            else:
+                logger.info(f"summarize: reusing cached summary for {filename}")
 
             if not summarize_response:
                 logger.info("summarize: nothing obtained from llm")
                 summaries_failed.append(f"{filename} (nothing obtained from llm)")
                 return filename, "", False
             else:
-                if not options.review_simple_changes:
+                if triage:
                     triage_regex = r"\[TRIAGE\]:\s*(NEEDS_REVIEW|APPROVED)"
                     triage_match = re.search(triage_regex, summarize_response)
 
@@ -226,79 +264,466 @@ and {pr_data["head"]["sha"]} commits.
             summaries_failed.append(f"{filename} (error from llm: {e})")
             return filename, "", False
 
-    summary_promises = []
-    skipped_files = []
-    for filename, file_content, file_diff, _ in files_and_changes:
-        if options.max_files <= 0 or len(summary_promises) < options.max_files:
-            async def semaphore_summary(filename, f_content, f_diff):
-                async with llm_concurrency_limit:
-                    return await do_summary(filename, f_content, f_diff)
-
-            summary_promises.append(
-                semaphore_summary(filename, file_content, file_diff)
-            )
-        else:
-            skipped_files.append(filename)
+    async def summarize_stage(file: FileChange) -> Optional[FileChange]:
+        filename, summary, needs_review = await do_summary(file.filename, file.file_content, file.file_diff,
+                                                        not options.review_simple_changes and not file.triaged)
+        summaries.append((filename, summary, needs_review))
+        if options.disable_review:
+            return None
+        # files that could not be summarized are still reviewed, only files triaged as APPROVED are skipped
+        if summary and not needs_review:
+            reviews_skipped.append(filename)
+            return None
+        # the review reads the parsed hunks, the whole diff is not kept until then
+        file.file_diff = ""
+        return file
+
+    reviews_failed = []
+    reviews_skipped = []
+    lgtm_count = 0
+    review_count = 0
+    review_cache = ResultCache(options.cache_dir, "reviews")
+    short_summary_ready = asyncio.Event()
+    # The review prompt contains the short summary of the whole pull request. When an earlier run left one, files
+    # are reviewed with it as soon as they are summarized; on the first run they wait for the new one.
+    review_with_previous_summary = bool(inputs.short_summary)
+
+    async def prepare_review(filename: str, patches: List[Tuple[int, int, str]], capacity: int) \
+            -> Optional[Tuple[List[Review], List[Tuple[int, int, str, str, str]], List[int]]]:
+        """Collect the comment chains and cached reviews of a file's hunks.
+
+        Returns the cached reviews, the (start_line, end_line, patch, comment_chain, cache_key) of the hunks left
+        for the model and their token counts, or None when no hunk fits in `capacity`.
+        """
+        cached_reviews: List[Review] = []
+        patches_to_review: List[Tuple[int, int, str, str, str]] = []
+        patches_tokens: List[int] = []
+        patches_too_large = 0
+        for start_line, end_line, patch in patches:
+            if pr_data is None:
+                logger.warning("No pull request found, skipping.")
+                continue
 
-    summaries = [
-        summary for summary in await asyncio.gather(*summary_promises)
-        if summary is not None
-    ]
+            patch_tokens = get_token_count(patch, options.llm_heavy_model)
+            if patch_tokens > capacity:
+                logger.info(f"unable to pack patch {start_line}-{end_line} of {filename} into a request, "
+                            f"tokens: {patch_tokens} / {capacity}")
+                patches_too_large += 1
+                continue
 
-    if summaries:
-        batch_size = 10
-        for i in range(0, len(summaries), batch_size):
-            summaries_batch = summaries[i:i + batch_size]
-            for filename, summary, _ in summaries_batch:
-                inputs.raw_summary += f"""---\n{filename}: {summary}\n"""
+            comment_chain = ""
+            try:
+                all_chains = await commenter.get_comment_chains_within_range(
+                    pr_data["number"],
+                    filename,
+                    start_line,
+                    end_line,
+                    COMMENT_REPLY_TAG
+                )
 
-            # Purpose of this step is to deduplicate and group together all the changes by file:
-            summarize_resp = await heavy_bot.chat(prompts.render_summarize_changesets(inputs))
-            if not summarize_resp:
-                logger.warning("summarize_resp: nothing obtained from llm")
+                if all_chains:
+                    logger.info(f"Found comment chains: {all_chains} for {filename}")
+                    comment_chain = all_chains
+            except Exception as e:
+                logger.warning(f"Failed to get comments: {e}, skipping.")
+
+            comment_chain_tokens = get_token_count(comment_chain, options.llm_heavy_model)
+            if patch_tokens + comment_chain_tokens > capacity:
+                comment_chain = ""
             else:
-                inputs.raw_summary = summarize_resp
+                patch_tokens += comment_chain_tokens
 
-    summarize_final_response = await heavy_bot.chat(prompts.render_summarize(inputs))
-    if not summarize_final_response:
-        logger.warning("summarize_final_response: nothing obtained from llm")
+            cache_key = ResultCache.key(patch, filename, comment_chain, heavy_bot.llm_options.model)
+            cached = review_cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"review: reusing cached review for {filename} lines {start_line}-{end_line}")
+                cached_reviews.extend(Review(**review) for review in cached)
+                continue
+            patches_to_review.append((start_line, end_line, patch, comment_chain, cache_key))
+            patches_tokens.append(patch_tokens)
+
+        if patches_too_large == len(patches):
+            reviews_skipped.append(f"{filename} (diff too large)")
+            return None
+        if patches_too_large:
+            reviews_skipped.append(f"{filename} ({patches_too_large} of {len(patches)} patches too large)")
+        return cached_reviews, patches_to_review, patches_tokens
+
+    def render_patches(request_patches: List[Tuple[int, int, str, str, str]]) -> str:
+        rendered = ""
+        for _, _, patch, comment_chain, _ in request_patches:
+            rendered += f"""
+{patch}
+"""
+            if comment_chain:
+                rendered += f"""
+---comment_chains---
+'''
+{comment_chain}
+'''
+"""
+            rendered += """
+---end_change_section---"""
+        return rendered
+
+    def cache_reviews(request_patches: List[Tuple[int, int, str, str, str]], request_reviews: List[Review]):
+        # parse_review maps every review into one of the patches it was given
+        for start_line, end_line, _, _, cache_key in request_patches:
+            review_cache.set(cache_key, [
+                vars(review) for review in request_reviews
+                if start_line <= review.start_line and review.end_line <= end_line
+            ])
+
+    async def buffer_reviews(filename: str, reviews: List[Review]):
+        nonlocal lgtm_count, review_count
+        for review in reviews:
+            if not options.review_comment_lgtm and (
+                    "LGTM" in review.comment or "looks good to me" in review.comment):
+                lgtm_count += 1
+                continue
+
+            if pr_data is None:
+                logger.warning("No pull request found, skipping.")
+                continue
 
-    if not options.disable_release_notes:
-        release_notes_response = await heavy_bot.chat(prompts.render_summarize_release_notes(inputs))
-        if not release_notes_response:
-            logger.info("release notes: nothing obtained from llm")
-        else:
-            message = "### Summary by SeineSailor\n\n" + release_notes_response
             try:
-                await commenter.update_description(pr_data["number"], message)
-            except Exception as err:
-                logger.warning(f"release notes: error from github: {err}")
+                review_count += 1
+                await commenter.buffer_review_comment(
+                    filename,
+                    review.start_line,
+                    review.end_line,
+                    review.comment
+                )
+            except Exception as e:
+                reviews_failed.append(f"{filename} comment failed ({e})")
 
-    summarize_short_response = await heavy_bot.chat(prompts.render_summarize_short(inputs))
-    inputs.short_summary = summarize_short_response
+    async def do_review(filename: str, f_content: str, patches: List[Tuple[int, int, str]]):
+        logger.info(f"reviewing {filename}")
+        ins = inputs.clone()
+        ins.filename = filename
+        if f_content:
+            ins.file_content = f_content
+
+        capacity = options.heavy_token_limits.request_tokens - prompts.count_review_file_diff(
+            ins, options.llm_heavy_model)
+        prepared = await prepare_review(filename, patches, capacity)
+        if prepared is None:
+            return
+        cached_reviews, patches_to_review, patches_tokens = prepared
+
+        if (options.review_batch_file_tokens > 0 and patches_to_review
+                and sum(patches_tokens) <= options.review_batch_file_tokens):
+            await batch_small_file(filename, cached_reviews, patches_to_review, sum(patches_tokens))
+            return
+
+        async def review_patches(indexes: List[int]) -> Optional[List[Review]]:
+            request = ins.clone()
+            request_patches = [patches_to_review[index] for index in indexes]
+            request.patches = render_patches(request_patches)
+
+            response = await heavy_bot.chat(prompts.render_review_file_diff(request), PRIORITY_LOW)
+            if not response:
+                logger.info("review: nothing obtained from llm")
+                reviews_failed.append(f"{filename} (no response)")
+                return None
+
+            request_reviews = parse_review(
+                response,
+                [(start_line, end_line, patch) for start_line, end_line, patch, _, _ in request_patches],
+                options.debug
+            )
+            cache_reviews(request_patches, request_reviews)
+            return request_reviews
 
-    summarize_comment = f"""{summarize_final_response}
-{RAW_SUMMARY_START_TAG}
-{inputs.raw_summary}
-{RAW_SUMMARY_END_TAG}
-{SHORT_SUMMARY_START_TAG}
-{inputs.short_summary}
-{SHORT_SUMMARY_END_TAG}
+        try:
+            reviews = cached_reviews
+            requests = pack_items(patches_tokens, capacity)
+            if len(requests) > 1:
+                logger.info(f"review: splitting {len(patches_to_review)} patches of {filename} "
+                            f"into {len(requests)} requests")
+            for request_reviews in await asyncio.gather(*[review_patches(indexes) for indexes in requests]):
+                if request_reviews:
+                    reviews = reviews + request_reviews
+
+            await buffer_reviews(filename, reviews)
+        except Exception as e:
+            logger.warning(f"Failed to review: {e}, skipping.")
+            reviews_failed.append(f"{filename} ({e})")
+
+    # Files with only a few changed lines are reviewed together, so they share the instructions and summaries of
+    # one request instead of paying for them once per file.
+    small_files: List[Tuple[str, List[Review], List[Tuple[int, int, str, str, str]]]] = []
+    small_files_tokens = 0
+
+    async def batch_small_file(filename: str, cached_reviews: List[Review],
+                               patches_to_review: List[Tuple[int, int, str, str, str]], tokens: int):
+        nonlocal small_files, small_files_tokens
+        capacity = options.heavy_token_limits.request_tokens - prompts.count_review_files_batch(
+            inputs, options.llm_heavy_model)
+        # the FILE: line of each file costs a few tokens as well
+        tokens += get_token_count(f"\nFILE: {filename}\n", options.llm_heavy_model)
+
+        batch = []
+        if small_files and (small_files_tokens + tokens > capacity or len(small_files) >= MAX_FILES_PER_BATCH):
+            batch, small_files, small_files_tokens = small_files, [], 0
+        small_files.append((filename, cached_reviews, patches_to_review))
+        small_files_tokens += tokens
+
+        if batch:
+            await review_files_batch(batch)
+
+    async def review_files_batch(batch: List[Tuple[str, List[Review], List[Tuple[int, int, str, str, str]]]]):
+        if len(batch) == 1:
+            filename, cached_reviews, patches_to_review = batch[0]
+            ins = inputs.clone()
+            ins.filename = filename
+            ins.patches = render_patches(patches_to_review)
+            try:
+                reviews = cached_reviews
+                response = await heavy_bot.chat(prompts.render_review_file_diff(ins), PRIORITY_LOW)
+                if not response:
+                    logger.info("review: nothing obtained from llm")
+                    reviews_failed.append(f"{filename} (no response)")
+                else:
+                    new_reviews = parse_review(
+                        response,
+                        [(start_line, end_line, patch) for start_line, end_line, patch, _, _ in patches_to_review],
+                        options.debug
+                    )
+                    cache_reviews(patches_to_review, new_reviews)
+                    reviews = reviews + new_reviews
+                await buffer_reviews(filename, reviews)
+            except Exception as e:
+                logger.warning(f"Failed to review: {e}, skipping.")
+                reviews_failed.append(f"{filename} ({e})")
+            return
+
+        logger.info(f"reviewing {len(batch)} small files together: {', '.join(filename for filename, _, _ in batch)}")
+        ins = inputs.clone()
+        for filename, _, patches_to_review in batch:
+            ins.patches += f"\nFILE: {filename}\n{render_patches(patches_to_review)}\n"
+
+        try:
+            response = await heavy_bot.chat(prompts.render_review_files_batch(ins), PRIORITY_LOW)
+            if not response:
+                logger.info("review: nothing obtained from llm")
+                error = "no response"
+            else:
+                reviews_by_file = parse_review_batch(
+                    response,
+                    {
+                        filename: [(start_line, end_line, patch)
+                                   for start_line, end_line, patch, _, _ in patches_to_review]
+                        for filename, _, patches_to_review in batch
+                    },
+                    options.debug
+                )
+                error = ""
+        except Exception as e:
+            logger.warning(f"Failed to review batch: {e}, skipping.")
+            error = str(e)
+
+        if error:
+            # the reviews already cached for these files are still posted
+            for filename, cached_reviews, _ in batch:
+                reviews_failed.append(f"{filename} ({error})")
+                await buffer_reviews(filename, cached_reviews)
+            return
+
+        missing = []
+        for entry in batch:
+            filename, cached_reviews, patches_to_review = entry
+            if filename not in reviews_by_file:
+                missing.append(entry)
+                continue
+            cache_reviews(patches_to_review, reviews_by_file[filename])
+            await buffer_reviews(filename, cached_reviews + reviews_by_file[filename])
+
+        if missing:
+            # the model did not copy their FILE: lines, so they are reviewed one by one instead
+            logger.warning(f"review: no comments for {', '.join(filename for filename, _, _ in missing)} "
+                           f"in the batched response, reviewing them separately")
+            await asyncio.gather(*[review_files_batch([entry]) for entry in missing])
+
+    async def review_stage(file: FileChange) -> None:
+        if not review_with_previous_summary:
+            await short_summary_ready.wait()
+        await do_review(file.filename, file.file_content, file.patches)
+
+    triage_approved = []
+    triage_needs_review = 0
+    triage_tokens = 0
+    triage_saved_tokens = 0
+
+    async def triage_batch(batch: List[FileChange]) -> List[FileChange]:
+        nonlocal triage_needs_review, triage_tokens, triage_saved_tokens
+        ins = inputs.clone()
+        ins.patches = render_triage_patches(batch)
+        try:
+            response = await light_bot.chat(prompts.render_triage_file_diffs(ins))
+        except Exception as e:
+            logger.warning(f"triage: error from llm: {e}")
+            response = ""
+        triage_tokens += prompts.count_triage_file_diffs(ins, options.llm_light_model)
+        decisions = parse_triage_batch(response)
+
+        needs_review = []
+        for file in batch:
+            decision = decisions.get(file.filename)
+            if decision == "APPROVED":
+                logger.info(f"filename: {file.filename}, triage: APPROVED")
+                triage_approved.append(file.filename)
+                reviews_skipped.append(file.filename)
+                file_ins = inputs.clone()
+                file_ins.filename = file.filename
+                file_ins.file_diff = file.file_diff
+                triage_saved_tokens += prompts.count_summarize_file_diff(file_ins, False, options.llm_light_model)
+                continue
+            if decision == "NEEDS_REVIEW":
+                triage_needs_review += 1
+                file.triaged = True
+            # files missing from the response are summarized with the triage instructions as before
+            needs_review.append(file)
+        return needs_review
+
+    async def triaged_files():
+        if options.review_simple_changes:
+            async for file in as_async_iterable(files_to_process):
+                yield file
+            return
+
+        base_tokens = prompts.count_triage_file_diffs(inputs, options.llm_light_model)
+        capacity = options.light_token_limits.request_tokens - base_tokens
+        # batches are triaged concurrently, files move on to summarization as soon as their batch is triaged
+        triaging = set()
+        batch: List[FileChange] = []
+        batch_tokens = 0
+        async for file in as_async_iterable(files_to_process):
+            tokens = get_token_count(render_triage_patches([file]), options.llm_light_model)
+            if tokens > capacity:
+                # too large to triage with others, the summary request triages it on its own
+                yield file
+            else:
+                if batch and (batch_tokens + tokens > capacity or len(batch) >= MAX_FILES_PER_TRIAGE):
+                    triaging.add(asyncio.ensure_future(triage_batch(batch)))
+                    batch, batch_tokens = [], 0
+                batch.append(file)
+                batch_tokens += tokens
+
+            for task in [task for task in triaging if task.done()]:
+                triaging.discard(task)
+                for triaged_file in task.result():
+                    yield triaged_file
+        if batch:
+            triaging.add(asyncio.ensure_future(triage_batch(batch)))
+
+        for triaged in asyncio.as_completed(triaging):
+            for file in await triaged:
+                yield file
+
+    # a file dropped by a failing stage is listed as not summarized or not reviewed
+    def summary_failed(file: FileChange, error: Exception):
+        summaries_failed.append(f"{file.filename} ({error})")
+
+    def review_failed(file: FileChange, error: Exception):
+        reviews_failed.append(f"{file.filename} ({error})")
+
+    # Bounded queues keep only the files in flight in memory and make the listing of a large pull request wait for
+    # room. The queue of the review stage stays unbounded while it waits for the short summary, which needs every
+    # file to be summarized first.
+    pipeline = Pipeline("code_review", label=lambda file: file.filename)
+    if file_content_needed:
+        pipeline.add_stage("fetch", retrieve_file_contents, options.github_concurrency_limit,
+                           queue_size=options.github_concurrency_limit, on_error=summary_failed)
+    # the bots adapt their own concurrency below these bounds, see AdaptiveConcurrencyLimiter in app/bot.py
+    pipeline.add_stage("summarize", summarize_stage, options.llm_max_concurrency_limit,
+                       queue_size=options.llm_max_concurrency_limit, on_error=summary_failed)
+    if not options.disable_review:
+        pipeline.add_stage("review", review_stage, options.llm_max_concurrency_limit,
+                           queue_size=options.llm_max_concurrency_limit if review_with_previous_summary else 0,
+                           on_error=review_failed)
+
+    final_summary_task: Optional[asyncio.Future] = None
+    release_notes_task: Optional[asyncio.Future] = None
+
+    async def summarize_pull_request():
+        nonlocal final_summary_task, release_notes_task
+        try:
+            await pipeline.wait_for_stage("summarize")
+
+            if summaries:
+                changesets = [inputs.raw_summary] if inputs.raw_summary else []
+                changesets += [f"""---\n{filename}: {summary}\n""" for filename, summary, _ in summaries]
+                inputs.raw_summary = await reduce_changesets(
+                    heavy_bot, prompts, inputs, changesets, options.heavy_token_limits.request_tokens
+                )
+
+            summarize_final_prompt = prompts.render_summarize(inputs)
+            release_notes_prompt = prompts.render_summarize_release_notes(inputs)
+
+            async def do_final_summary() -> str:
+                summarize_final_resp = await heavy_bot.chat(summarize_final_prompt)
+                if not summarize_final_resp:
+                    logger.warning("summarize_final_response: nothing obtained from llm")
+                return summarize_final_resp
+
+            async def do_release_notes():
+                if options.disable_release_notes:
+                    return
+
+                release_notes_response = await heavy_bot.chat(release_notes_prompt)
+                if not release_notes_response:
+                    logger.info("release notes: nothing obtained from llm")
+                else:
+                    message = "### Summary by SeineSailor\n\n" + release_notes_response
+                    try:
+                        await commenter.update_description(pr_data["number"], message)
+                    except Exception as err:
+                        logger.warning(f"release notes: error from github: {err}")
+
+            # Only the short summary is an input of the review prompt, so the final summary and the release notes
+            # run in the background while the files are being reviewed.
+            final_summary_task = asyncio.ensure_future(do_final_summary())
+            release_notes_task = asyncio.ensure_future(do_release_notes())
+
+            summarize_short_response = await heavy_bot.chat(prompts.render_summarize_short(inputs))
+            inputs.short_summary = summarize_short_response
+        finally:
+            short_summary_ready.set()
+
+    await asyncio.gather(pipeline.run(triaged_files()), summarize_pull_request())
+    if local:
+        await local.close()
+    if small_files:
+        await review_files_batch(small_files)
+
+    triage_approved_list = "" if not triage_approved else f"""
+* {chr(10).join(triage_approved)}
 """
-# ---
-#
-# <details>
-# <summary>Uplevel your code reviews with SeineSailor Pro</summary>
-#
-# ### SeineSailor Pro
-#
-# If you like this project, please support us by purchasing the [Pro version](https://SeineSailor.ai).
-    # The Pro version has advanced context, superior noise reduction and several proprietary improvements compared to
-    # the open source version. Moreover, SeineSailor Pro is free for open source projects.
-#
-# </details>
-# """
+    if streaming:
+        status_msg += f'''
+{"" if not filter_selected_files else f"""
+<details>
+<summary>Files selected ({len(filter_selected_files)})</summary>
+
+* {chr(10).join(filter_selected_files)}
+</details>
+"""}
+{"" if not filter_ignored_files else f"""
+<details>
+<summary>Files ignored due to filter ({len(filter_ignored_files)})</summary>
 
+* {chr(10).join(filter_ignored_files)}
+
+</details>
+"""}
+{"" if not pull_files.limit_reached else f"""
+GitHub lists at most {PULL_FILES_LIMIT} files of a pull request, the files after them were not reviewed.
+"""}
+{"" if not listing_stopped else f"""
+The max files limit was reached, the remaining files of the pull request were not listed.
+"""}
+'''
     status_msg += f'''
 {"" if not skipped_files else f"""
 <details>
@@ -316,142 +741,37 @@ and {pr_data["head"]["sha"]} commits.
 
 </details>
 """}
-'''
+{"" if options.review_simple_changes else f"""
+<details>
+<summary>Files triaged before summarization ({len(triage_approved) + triage_needs_review})</summary>
 
-    if not options.disable_review:
-        files_and_changes_review = [
-            (filename, file_content, file_diff, patches)
-            for filename, file_content, file_diff, patches in files_and_changes
-            if any(summary_filename == filename for summary_filename, _, _ in summaries)
-        ]
-
-        reviews_skipped = [
-            filename for filename, _, _, _ in files_and_changes
-            if filename not in [filename for filename, _, _, _ in files_and_changes_review]
-        ]
-
-        reviews_failed = []
-        lgtm_count = 0
-        review_count = 0
-
-        async def do_review(filename: str, f_content: str, patches: List[Tuple[int, int, str]]):
-            nonlocal lgtm_count, review_count
-            logger.info(f"reviewing {filename}")
-            ins = inputs.clone()
-            ins.filename = filename
+Needs review: {triage_needs_review}
+Approved: {len(triage_approved)}
+{triage_approved_list}
+Batched triage used {triage_tokens} prompt tokens and saved about {triage_saved_tokens} summary prompt tokens.
 
-            tokens = get_token_count(prompts.render_review_file_diff(ins))
-            patches_to_pack = 0
-            for _, _, patch in patches:
-                patch_tokens = get_token_count(patch)
-                if tokens + patch_tokens > options.heavy_token_limits.request_tokens:
-                    logger.info(
-                        f"only packing {patches_to_pack} / {len(patches)} patches, "
-                        f"tokens: {tokens} / {options.heavy_token_limits.request_tokens}")
-                    break
-                tokens += patch_tokens
-                patches_to_pack += 1
-
-            patches_packed = 0
-            for start_line, end_line, patch in patches:
-                if pr_data is None:
-                    logger.warning("No pull request found, skipping.")
-                    continue
-
-                if patches_packed >= patches_to_pack:
-                    logger.info(
-                        f"unable to pack more patches into this request, "
-                        f"packed: {patches_packed}, total patches: {len(patches)}, skipping.")
-                    if options.debug:
-                        logger.info(f"prompt so far: {prompts.render_review_file_diff(ins)}")
-                    break
-                patches_packed += 1
+</details>
+"""}
+{"" if not (file_content_needed and blob_store.cache.enabled) else f"""
+<details>
+<summary>Cached file contents ({blob_store.stats()})</summary>
 
-                comment_chain = ""
-                try:
-                    all_chains = await commenter.get_comment_chains_within_range(
-                        pr_data["number"],
-                        filename,
-                        start_line,
-                        end_line,
-                        COMMENT_REPLY_TAG
-                    )
+Base versions of files unchanged since a previous run were read from the cache instead of GitHub.
 
-                    if all_chains:
-                        logger.info(f"Found comment chains: {all_chains} for {filename}")
-                        comment_chain = all_chains
-                except Exception as e:
-                    logger.warning(f"Failed to get comments: {e}, skipping.")
+</details>
+"""}
+{"" if not summary_cache.enabled else f"""
+<details>
+<summary>Cached file summaries ({summary_cache.stats()})</summary>
 
-                comment_chain_tokens = get_token_count(comment_chain)
-                if tokens + comment_chain_tokens > options.heavy_token_limits.request_tokens:
-                    comment_chain = ""
-                else:
-                    tokens += comment_chain_tokens
+Files whose diff was summarized in a previous run reused that summary instead of calling the LLM.
 
-                ins.patches += f"""
-{patch}
-"""
-                if comment_chain:
-                    ins.patches += f"""
----comment_chains---
-'''
-{comment_chain}
+</details>
+"""}
 '''
-"""
-                ins.patches += """
----end_change_section---"""
-
-            if patches_packed > 0:
-                try:
-                    response = await heavy_bot.chat(prompts.render_review_file_diff(ins))
-                    if not response:
-                        logger.info("review: nothing obtained from llm")
-                        reviews_failed.append(f"{filename} (no response)")
-                        return
-
-                    reviews = parse_review(response, patches, options.debug)
-                    for review in reviews:
-                        if not options.review_comment_lgtm and (
-                                "LGTM" in review.comment or "looks good to me" in review.comment):
-                            lgtm_count += 1
-                            continue
-
-                        if pr_data is None:
-                            logger.warning("No pull request found, skipping.")
-                            continue
-
-                        try:
-                            review_count += 1
-                            await commenter.buffer_review_comment(
-                                filename,
-                                review.start_line,
-                                review.end_line,
-                                review.comment
-                            )
-                        except Exception as e:
-                            reviews_failed.append(f"{filename} comment failed ({e})")
-                except Exception as e:
-                    logger.warning(f"Failed to review: {e}, skipping.")
-                    reviews_failed.append(f"{filename} ({e})")
-            else:
-                reviews_skipped.append(f"{filename} (diff too large)")
-
-        review_promises = []
-        for filename, file_content, _, patches in files_and_changes_review:
-            if options.max_files <= 0 or len(review_promises) < options.max_files:
-                async def semaphore_review(filename, f_content, patches):
-                    async with llm_concurrency_limit:
-                        return await do_review(filename, f_content, patches)
-
-                review_promises.append(
-                    semaphore_review(filename, file_content, patches)
-                )
-            else:
-                skipped_files.append(filename)
-
-        await asyncio.gather(*review_promises)
 
+    reviewed_commit_ids_block = ""
+    if not options.disable_review:
         status_msg += f'''
 {"" if not reviews_failed else f"""<details>
 <summary>Files not reviewed due to errors ({len(reviews_failed)})</summary>
@@ -474,6 +794,14 @@ Review: {review_count}
 LGTM: {lgtm_count}
 
 </details>
+{"" if not review_cache.enabled else f"""
+<details>
+<summary>Cached hunk reviews ({review_cache.stats()})</summary>
+
+Hunks reviewed in a previous run with the same content and comment chains reused that review.
+
+</details>
+"""}
 
 <details>
 <summary>Tips</summary>
@@ -494,8 +822,8 @@ Add @SeineSailor: ignore anywhere in the PR description to pause further reviews
 
 </details>
 '''
-        summarize_comment += f"""\n{commenter.add_reviewed_commit_id(existing_commit_ids_block,
-                                                                     pr_data["head"]["sha"])}"""
+        reviewed_commit_ids_block = f"""\n{commenter.add_reviewed_commit_id(existing_commit_ids_block,
+                                                                            pr_data["head"]["sha"])}"""
 
         await commenter.submit_review(
             pr_data["number"],
@@ -503,9 +831,144 @@ Add @SeineSailor: ignore anywhere in the PR description to pause further reviews
             status_msg
         )
 
+    summarize_final_response, _ = await asyncio.gather(final_summary_task, release_notes_task)
+
+    summarize_comment = f"""{summarize_final_response}
+{RAW_SUMMARY_START_TAG}
+{inputs.raw_summary}
+{RAW_SUMMARY_END_TAG}
+{SHORT_SUMMARY_START_TAG}
+{inputs.short_summary}
+{SHORT_SUMMARY_END_TAG}
+"""
+# ---
+#
+# <details>
+# <summary>Uplevel your code reviews with SeineSailor Pro</summary>
+#
+# ### SeineSailor Pro
+#
+# If you like this project, please support us by purchasing the [Pro version](https://SeineSailor.ai).
+    # The Pro version has advanced context, superior noise reduction and several proprietary improvements compared to
+    # the open source version. Moreover, SeineSailor Pro is free for open source projects.
+#
+# </details>
+# """
+    summarize_comment += reviewed_commit_ids_block
+
     await commenter.comment(summarize_comment, SUMMARIZE_TAG, "replace", pr_data["number"])
 
 
+async def reduce_changesets(bot: Bot, prompts: Prompts, inputs: Inputs, changesets: List[str],
+                            token_limit: int) -> str:
+    """Deduplicate and group changesets with a tree of concurrent summarize_changesets requests.
+
+    Each round packs neighbouring changesets into batches that fit in `token_limit` and merges all batches in
+    parallel (bounded by the bot's concurrency limit), so the number of sequential LLM round-trips grows with
+    log(n) instead of n.
+    """
+    ins = inputs.clone()
+    ins.raw_summary = ""
+    budget = token_limit - prompts.count_summarize_changesets(ins, bot.llm_options.model)
+
+    while len(changesets) > 1:
+        batches = []
+        batch_tokens = 0
+        for changeset in changesets:
+            changeset_tokens = get_token_count(changeset, bot.llm_options.model)
+            if batches and batch_tokens + changeset_tokens <= budget:
+                batches[-1].append(changeset)
+                batch_tokens += changeset_tokens
+            else:
+                batches.append([changeset])
+                batch_tokens = changeset_tokens
+
+        if len(batches) == len(changesets):
+            logger.warning("summarize_changesets: changesets are too large to merge within the token limit")
+            break
+
+        async def merge(batch: List[str]) -> Tuple[str, bool]:
+            if len(batch) == 1:
+                return batch[0], False
+
+            batch_inputs = inputs.clone()
+            batch_inputs.raw_summary = "".join(batch)
+            # Purpose of this step is to deduplicate and group together all the changes by file:
+            summarize_resp = await bot.chat(prompts.render_summarize_changesets(batch_inputs))
+            if not summarize_resp:
+                logger.warning("summarize_resp: nothing obtained from llm")
+                return batch_inputs.raw_summary, False
+            return f"{summarize_resp}\n", True
+
+        merged = await asyncio.gather(*[merge(batch) for batch in batches])
+        if not any(ok for _, ok in merged):
+            break
+        changesets = [changeset for changeset, _ in merged]
+
+    return "".join(changesets)
+
+
+def pack_items(sizes: List[int], capacity: int) -> List[List[int]]:
+    """Pack items into as few bins of `capacity` as first-fit decreasing finds.
+
+    Returns the indexes of the items in each bin, in their original order. Items larger than `capacity` get a bin
+    of their own.
+    """
+    bins: List[List[int]] = []
+    bin_sizes: List[int] = []
+    for index in sorted(range(len(sizes)), key=lambda i: sizes[i], reverse=True):
+        for bin_index, bin_size in enumerate(bin_sizes):
+            if bin_size + sizes[index] <= capacity:
+                bins[bin_index].append(index)
+                bin_sizes[bin_index] += sizes[index]
+                break
+        else:
+            bins.append([index])
+            bin_sizes.append(sizes[index])
+    return [sorted(indexes) for indexes in bins]
+
+
+class FileChange:
+    def __init__(self, filename: str, file_diff: str, patches: List[Tuple[int, int, str]]):
+        self.filename = filename
+        self.file_diff = file_diff
+        self.patches = patches
+        self.file_content = ""
+        # set when the batched triage already decided the file needs review
+        self.triaged = False
+
+
+async def as_async_iterable(items):
+    if hasattr(items, "__aiter__"):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+def parse_file_patches(file_diff: str) -> List[Tuple[int, int, str]]:
+    """Split a file diff into (start_line, end_line, hunks) tuples, annotated for the review prompt."""
+    patches = []
+    for patch in split_patch(file_diff):
+        hunks, patch_lines = parse_patch(patch)
+        if not patch_lines:
+            continue
+        hunks_str = f"""
+---new_hunk---
+'''
+{hunks["new_hunk"]}
+'''
+
+---old_hunk---
+'''
+{hunks["old_hunk"]}
+'''
+"""
+        patches.append((patch_lines["new_hunk"]["start_line"], patch_lines["new_hunk"]["end_line"], hunks_str))
+    return patches
+
+
 def split_patch(patch: str) -> List[str]:
     if patch is None:
         return []
@@ -711,3 +1174,41 @@ def parse_review(response: str, patches: List[Tuple[int, int, str]], debug=False
     store_review()
 
     return reviews
+
+
+def parse_review_batch(response: str, patches_by_file: Dict[str, List[Tuple[int, int, str]]],
+                       debug=False) -> Dict[str, List[Review]]:
+    """Parse the response to a batched review request, routing the comments to files by their `FILE:` lines."""
+    file_line_regex = re.compile(r"^[#*\s]*FILE:\s*[`*]*(.+?)[`*]*\s*$")
+
+    sections: Dict[str, List[str]] = {}
+    current_filename = None
+    for line in response.split("\n"):
+        file_line_match = file_line_regex.match(line)
+        if file_line_match:
+            current_filename = file_line_match.group(1).strip()
+            if current_filename not in patches_by_file:
+                logger.warning(f"Ignoring comments for unknown file {current_filename} in batched review")
+                current_filename = None
+            else:
+                sections.setdefault(current_filename, [])
+            continue
+
+        if current_filename:
+            sections[current_filename].append(line)
+
+    return {
+        filename: parse_review("\n".join(lines), patches_by_file[filename], debug)
+        for filename, lines in sections.items()
+    }
+
+
+def render_triage_patches(files: List[FileChange]) -> str:
+    return "".join(f"\nFILE: {file.filename}\n```diff\n{file.file_diff}\n```\n" for file in files)
+
+
+def parse_triage_batch(response: str) -> Dict[str, str]:
+    decisions = {}
+    for match in re.finditer(r"FILE:\s*[`*]*(.+?)[`*]*\s*\[TRIAGE\]:\s*[`*]*(NEEDS_REVIEW|APPROVED)", response or ""):
+        decisions[match.group(1).strip()] = match.group(2)
+    return decisions
@@ -4,7 +4,9 @@ from app.commenter import COMMENT_REPLY_TAG, COMMENT_TAG, SUMMARIZE_TAG
 from app.inputs import Inputs
 from app.tokenizer import get_token_count
 from app.bot import Bot
-from app.context import commenter, context, repo
+from app.diff import DiffSnapshot, PullRequestFiles
+from app.local_git import LocalGit
+from app.context import commenter, context, github
 from app.logger import setup_logger
 
 # Setup logger
@@ -44,7 +46,7 @@ async def handle_review_comment(heavy_bot: Bot, options: Options, prompts: Promp
         inputs.diff = comment.get("diff_hunk", "")
         inputs.filename = comment["path"]
 
-        comment_obj = commenter.get_pull_request_comment(pull_number, comment['id'])
+        comment_obj = await commenter.get_pull_request_comment(pull_number, comment['id'])
         comment_chain_result = await commenter.get_comment_chain(pull_number, comment_obj)
         comment_chain = comment_chain_result["chain"]
         top_level_comment = comment_chain_result["top_level_comment"]
@@ -59,13 +61,17 @@ async def handle_review_comment(heavy_bot: Bot, options: Options, prompts: Promp
             file_diff = ""
             try:
                 # get diff for this file by comparing the base and head commits
-                diff_all = repo.compare(pr_data["base"]["sha"], pr_data["head"]["sha"])
-                files = diff_all.files if diff_all else None
-
-                if files:
-                    file_info = next((f for f in files if f.filename == comment["path"]), None)
-                    if file_info and file_info.patch:
-                        file_diff = file_info.patch
+                local = await LocalGit.open(options.local_git_dir)
+                diff = await DiffSnapshot.fetch(github, pr_data["base"]["sha"], pr_data["head"]["sha"], local=local)
+                file_info = diff.get_file(comment["path"])
+                if file_info is None and diff.truncated:
+                    # the compare API stops at 300 files, look further in the files of the pull request
+                    async for file in PullRequestFiles(github, pull_number):
+                        if file.filename == comment["path"]:
+                            file_info = file
+                            break
+                if file_info and file_info.patch:
+                    file_diff = file_info.patch
 
             except Exception as error:
                 logger.warning(f"Failed to get file diff: {error}, skipping.")
@@ -82,7 +88,7 @@ async def handle_review_comment(heavy_bot: Bot, options: Options, prompts: Promp
                 )
                 return
 
-            tokens = get_token_count(prompts.render_comment(inputs))
+            tokens = prompts.count_comment(inputs, options.llm_heavy_model)
 
             if tokens > options.heavy_token_limits.request_tokens:
                 await commenter.review_comment_reply(
@@ -93,8 +99,8 @@ async def handle_review_comment(heavy_bot: Bot, options: Options, prompts: Promp
                 return
 
             if file_diff:
-                file_diff_count = prompts.comment.count("$file_diff")
-                file_diff_tokens = get_token_count(file_diff)
+                file_diff_count = prompts.compile(prompts.comment).count_variable("file_diff")
+                file_diff_tokens = get_token_count(file_diff, options.llm_heavy_model)
 
                 if (file_diff_count and tokens + file_diff_tokens * file_diff_count
                         <= options.heavy_token_limits.request_tokens):
@@ -104,7 +110,7 @@ async def handle_review_comment(heavy_bot: Bot, options: Options, prompts: Promp
             summary = await commenter.find_comment_with_tag(SUMMARIZE_TAG, pull_number)
             if summary:
                 short_summary = commenter.get_short_summary(summary.body)
-                short_summary_tokens = get_token_count(short_summary)
+                short_summary_tokens = get_token_count(short_summary, options.llm_heavy_model)
 
                 if tokens + short_summary_tokens <= options.heavy_token_limits.request_tokens:
                     tokens += short_summary_tokens
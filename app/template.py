@@ -0,0 +1,71 @@
+import re
+import functools
+from typing import Any, Dict, List, Tuple
+from app.tokenizer import get_token_count
+
+TEMPLATE_VARIABLES = [
+    "system_message", "title", "description", "raw_summary", "short_summary", "filename", "file_content",
+    "file_diff", "patches", "diff", "comment_chain", "comment"
+]
+# longest names first, so that `$comment_chain` is never read as `$comment` followed by `_chain`
+VARIABLE_PATTERN = re.compile(r"\$(" + "|".join(sorted(TEMPLATE_VARIABLES, key=len, reverse=True)) + ")")
+
+
+class CompiledTemplate:
+    """A prompt template split into literal text fragments and `$variable` references.
+
+    Rendering joins the fragments with the variable values in a single pass, so a prompt holding whole diffs is
+    copied once instead of once per variable, and `$` sequences inside the values are never substituted.
+
+    Token counts of the literal fragments are computed once per model, so the size of a rendered prompt is the sum of
+    those counts and the counts of the variable values, without rendering and re-encoding the whole prompt. The sum
+    can differ from encoding the rendered prompt by a few tokens where BPE merges across fragment boundaries.
+    """
+
+    def __init__(self, template: str):
+        self.template = template
+        self.parts: List[Tuple[bool, str]] = []
+        last = 0
+        for match in VARIABLE_PATTERN.finditer(template):
+            if match.start() > last:
+                self.parts.append((False, template[last:match.start()]))
+            self.parts.append((True, match.group(1)))
+            last = match.end()
+        if last < len(template):
+            self.parts.append((False, template[last:]))
+        self.variables = [value for is_variable, value in self.parts if is_variable]
+        self._literal_tokens: Dict[str, int] = {}
+
+    def uses(self, variable: str) -> bool:
+        return variable in self.variables
+
+    def count_variable(self, variable: str) -> int:
+        return self.variables.count(variable)
+
+    def render(self, inputs: Any) -> str:
+        return "".join(getattr(inputs, value) if is_variable else value for is_variable, value in self.parts)
+
+    def literal_tokens(self, model: str = "") -> int:
+        if model not in self._literal_tokens:
+            self._literal_tokens[model] = sum(
+                get_token_count(value, model) for is_variable, value in self.parts if not is_variable
+            )
+        return self._literal_tokens[model]
+
+    def variable_sizes(self, inputs: Any) -> Dict[str, int]:
+        """Characters each variable contributes to the rendered prompt."""
+        return {variable: len(getattr(inputs, variable)) * self.variables.count(variable)
+                for variable in set(self.variables)}
+
+    def variable_tokens(self, inputs: Any, model: str = "") -> Dict[str, int]:
+        """Tokens each variable contributes to the rendered prompt."""
+        return {variable: get_token_count(getattr(inputs, variable), model) * self.variables.count(variable)
+                for variable in set(self.variables)}
+
+    def count_tokens(self, inputs: Any, model: str = "") -> int:
+        return self.literal_tokens(model) + sum(self.variable_tokens(inputs, model).values())
+
+
+@functools.lru_cache(maxsize=64)
+def compile_template(template: str) -> CompiledTemplate:
+    return CompiledTemplate(template)
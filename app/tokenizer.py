@@ -1,12 +1,109 @@
+import math
+import hashlib
+import threading
+import functools
+from collections import OrderedDict
+from typing import Tuple
 import tiktoken
+from app.logger import setup_logger
 
-tokenizer = tiktoken.get_encoding("cl100k_base")
+logger = setup_logger("tokenizer")
 
+# Inputs longer than this many characters are estimated from their length instead of being encoded.
+APPROXIMATION_THRESHOLD = 500_000
+# Counts of inputs up to this many characters are kept in an LRU cache of this many entries.
+CACHEABLE_LENGTH = 64_000
+TOKEN_COUNT_CACHE_SIZE = 4096
 
-def encode(input_text: str) -> list:
-    return tokenizer.encode(input_text)
+# (model name substring, tiktoken encoding, scale, characters per token). The first match wins.
+# Models without a tiktoken encoding are counted with the closest one and scaled by the approximate ratio of their
+# own tokenizer's counts to it: Llama 3 uses a 128k BPE vocabulary close to cl100k_base, while the 32k
+# SentencePiece vocabulary of Mistral models produces noticeably more tokens for the same text.
+TOKENIZER_REGISTRY = [
+    ("gpt-4o", "o200k_base", 1.0, 4.0),
+    ("gpt-4", "cl100k_base", 1.0, 4.0),
+    ("gpt-3.5", "cl100k_base", 1.0, 4.0),
+    ("llama-3", "cl100k_base", 1.0, 4.0),
+    ("mixtral", "cl100k_base", 1.2, 3.3),
+    ("mistral", "cl100k_base", 1.2, 3.3),
+]
+DEFAULT_TOKENIZER = ("", "cl100k_base", 1.0, 4.0)
 
 
-def get_token_count(input_text: str) -> int:
-    input_text = input_text.replace("<|endoftext|>", "")
-    return len(encode(input_text))
+class Tokenizer:
+    def __init__(self, encoding_name: str, scale: float = 1.0, chars_per_token: float = 4.0):
+        self.encoding_name = encoding_name
+        self.scale = scale
+        self.chars_per_token = chars_per_token
+        self._encoding = None
+
+    @property
+    def encoding(self) -> tiktoken.Encoding:
+        # loading an encoding reads (and on first use downloads) its BPE ranks, so only do it when needed
+        if self._encoding is None:
+            try:
+                self._encoding = tiktoken.get_encoding(self.encoding_name)
+            except ValueError as e:
+                # older tiktoken releases do not ship every encoding, e.g. o200k_base
+                logger.warning(f"{e}, counting tokens with {DEFAULT_TOKENIZER[1]} instead")
+                self._encoding = tiktoken.get_encoding(DEFAULT_TOKENIZER[1])
+        return self._encoding
+
+    def encode(self, input_text: str) -> list:
+        return self.encoding.encode(input_text, disallowed_special=())
+
+    def count(self, input_text: str) -> int:
+        if len(input_text) > APPROXIMATION_THRESHOLD:
+            # chars_per_token is the model's own ratio, the scale to cl100k_base counts is already part of it
+            return math.ceil(len(input_text) / self.chars_per_token)
+        return math.ceil(len(self.encode(input_text)) * self.scale)
+
+
+@functools.lru_cache(maxsize=None)
+def get_tokenizer(model: str = "") -> Tokenizer:
+    for substring, encoding_name, scale, chars_per_token in TOKENIZER_REGISTRY:
+        if substring in model:
+            return Tokenizer(encoding_name, scale, chars_per_token)
+    _, encoding_name, scale, chars_per_token = DEFAULT_TOKENIZER
+    return Tokenizer(encoding_name, scale, chars_per_token)
+
+
+def encode(input_text: str, model: str = "") -> list:
+    return get_tokenizer(model).encode(input_text)
+
+
+class TokenCountCache:
+    """LRU cache of token counts keyed by a digest of the text, so that it does not keep the texts alive."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.counts: "OrderedDict[Tuple[bytes, str], int]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def count(self, input_text: str, model: str) -> int:
+        key = (hashlib.blake2b(input_text.encode("utf-8", "surrogatepass"), digest_size=16).digest(), model)
+        with self.lock:
+            count = self.counts.get(key)
+            if count is not None:
+                self.counts.move_to_end(key)
+                return count
+
+        count = get_tokenizer(model).count(input_text)
+        with self.lock:
+            self.counts[key] = count
+            if len(self.counts) > self.maxsize:
+                self.counts.popitem(last=False)
+        return count
+
+    def clear(self):
+        with self.lock:
+            self.counts.clear()
+
+
+token_count_cache = TokenCountCache(TOKEN_COUNT_CACHE_SIZE)
+
+
+def get_token_count(input_text: str, model: str = "") -> int:
+    if len(input_text) <= CACHEABLE_LENGTH:
+        return token_count_cache.count(input_text, model)
+    return get_tokenizer(model).count(input_text)
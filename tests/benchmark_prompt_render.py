@@ -0,0 +1,37 @@
+import time
+from app.inputs import Inputs
+from app.prompts import Prompts
+
+VARIABLES = ["system_message", "title", "description", "raw_summary", "short_summary", "filename", "file_content",
+             "file_diff", "patches", "diff", "comment_chain", "comment"]
+
+
+def render_with_replace(inputs: Inputs, content: str) -> str:
+    """The rendering CompiledTemplate replaced: one str.replace pass over the whole prompt per variable."""
+    for variable in VARIABLES:
+        content = content.replace(f"${variable}", getattr(inputs, variable))
+    return content
+
+
+# Renders a review prompt holding a 1 MB patch set, in one pass against one str.replace pass per variable.
+# Run from the repository root with `python -m tests.benchmark_prompt_render`.
+if __name__ == "__main__":
+    prompts = Prompts()
+    big = Inputs(title="Benchmark", description="A 1 MB diff", short_summary="Adds many values.")
+    big.patches = "\n".join(f"{line}: +    value_{line} = compute(value_{line - 1}, {line})"
+                            for line in range(1, 20000))[:1_000_000]
+
+    rounds = 50
+    start = time.perf_counter()
+    for _ in range(rounds):
+        render_with_replace(big, prompts.review_file_diff)
+    replace_time = (time.perf_counter() - start) / rounds
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        prompts.render_review_file_diff(big)
+    compiled_time = (time.perf_counter() - start) / rounds
+
+    sizes = prompts.compile(prompts.review_file_diff).variable_sizes(big)
+    print(f"render 1 MB patches: replace {replace_time * 1000:.2f}ms, compiled {compiled_time * 1000:.2f}ms, "
+          f"largest variables: {sorted(sizes.items(), key=lambda item: -item[1])[:3]}")
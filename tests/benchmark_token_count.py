@@ -0,0 +1,33 @@
+import time
+from app.inputs import Inputs
+from app.prompts import Prompts
+from app.tokenizer import get_token_count, token_count_cache
+
+# Packs the hunks of a 5,000-line diff one at a time, the way do_review does: re-rendering and encoding the whole
+# prompt after every hunk, against counting the prompt once and adding the count of each hunk.
+# Run from the repository root with `python -m tests.benchmark_token_count`.
+if __name__ == "__main__":
+    prompts = Prompts()
+    hunks = [
+        "\n".join(f"{line}: +    value_{line} = compute(value_{line - 1}, {line})" for line in range(start, start + 50))
+        for start in range(1, 5001, 50)
+    ]
+    ins = Inputs(title="Benchmark", description="A 5,000 line diff", short_summary="Adds many values.")
+
+    token_count_cache.clear()
+    start = time.perf_counter()
+    packed = ins.clone()
+    for hunk in hunks:
+        packed.patches += hunk
+        get_token_count(prompts.render_review_file_diff(packed))
+    render_time = time.perf_counter() - start
+
+    token_count_cache.clear()
+    start = time.perf_counter()
+    tokens = prompts.count_review_file_diff(ins)
+    for hunk in hunks:
+        tokens += get_token_count(hunk)
+    incremental_time = time.perf_counter() - start
+
+    print(f"re-render and encode: {render_time:.3f}s, incremental: {incremental_time:.3f}s, "
+          f"tokens: {get_token_count(prompts.render_review_file_diff(packed))} vs {tokens}")
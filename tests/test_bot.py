@@ -0,0 +1,41 @@
+import asyncio
+import httpx
+import openai
+import requests
+from app.bot import AdaptiveConcurrencyLimiter, is_retryable
+
+
+def test_burst_of_rate_limits_halves_the_limit_once():
+    async def burst():
+        limiter = AdaptiveConcurrencyLimiter(6, 12)
+        decreases = await asyncio.gather(*[limiter.acquire() for _ in range(6)])
+        # every request in flight is rate limited at once
+        for sent_with in decreases:
+            await limiter.release(sent_with, overloaded=True)
+        after_burst = limiter.limit
+
+        # a request sent under the decreased limit that is rate limited too decreases it again
+        await limiter.release(await limiter.acquire(), overloaded=True)
+        return after_burst, limiter.limit, limiter.in_flight
+
+    assert asyncio.run(burst()) == (3.0, 1.5, 0)
+
+
+def test_only_transport_errors_and_transient_statuses_are_retried():
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+
+    def status_error(status_code):
+        response = httpx.Response(status_code, request=request)
+        return openai.APIStatusError("error", response=response, body=None)
+
+    assert is_retryable(asyncio.TimeoutError())
+    assert is_retryable(openai.APITimeoutError(request=request))
+    assert is_retryable(httpx.ConnectError("connection refused", request=request))
+    assert is_retryable(requests.exceptions.ConnectionError())
+    assert is_retryable(status_error(429))
+    assert is_retryable(status_error(503))
+
+    assert not is_retryable(status_error(400))
+    assert not is_retryable(status_error(401))
+    assert not is_retryable(ValueError("bad prompt"))
+    assert not is_retryable(TypeError("unexpected argument"))
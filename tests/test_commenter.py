@@ -0,0 +1,94 @@
+import time
+import random
+import asyncio
+from types import SimpleNamespace
+from app.commenter import Commenter, ReviewCommentIndex
+from app.github_client import AsyncGitHub
+
+
+# the linear scans ReviewCommentIndex replaced
+def scan_within_range(comments, path, start_line, end_line):
+    return [comment for comment in comments if comment.path == path and comment.body and (
+            (comment.start_line is not None and comment.start_line >= start_line and comment.line <= end_line) or
+            (start_line == end_line and comment.line == end_line))]
+
+
+def scan_at_range(comments, path, start_line, end_line):
+    return [comment for comment in comments if comment.path == path and comment.body and (
+            (comment.start_line is not None and comment.start_line == start_line and comment.line == end_line) or
+            (start_line == end_line and comment.line == end_line))]
+
+
+def random_comments(rng: random.Random, count: int):
+    comments = []
+    for i in range(count):
+        line = rng.randint(1, 30)
+        start_line = rng.choice([None, rng.randint(1, line)])
+        # comments on outdated diffs have neither line
+        outdated = rng.random() < 0.2
+        comments.append(SimpleNamespace(
+            id=i + 1,
+            path=rng.choice(["a.py", "b.py"]),
+            body=rng.choice(["comment", "comment", ""]),
+            line=None if outdated else line,
+            start_line=None if outdated else start_line,
+            in_reply_to_id=rng.choice([None, None, rng.randint(1, i + 1)]),
+        ))
+    return comments
+
+
+def test_index_matches_linear_scans():
+    rng = random.Random(16)
+    for _ in range(300):
+        comments = random_comments(rng, rng.randint(0, 80))
+        index = ReviewCommentIndex(comments)
+        for _ in range(30):
+            path = rng.choice(["a.py", "b.py"])
+            start_line = rng.randint(1, 30)
+            end_line = rng.choice([start_line, rng.randint(start_line, 30)])
+            assert [comment.id for comment in index.within_range(path, start_line, end_line)] == \
+                   [comment.id for comment in scan_within_range(comments, path, start_line, end_line)]
+            assert [comment.id for comment in index.at_range(path, start_line, end_line)] == \
+                   [comment.id for comment in scan_at_range(comments, path, start_line, end_line)]
+        for comment in comments:
+            assert [reply.id for reply in index.replies(comment.id)] == \
+                   [reply.id for reply in comments if reply.in_reply_to_id == comment.id]
+
+
+def test_concurrent_lookups_share_one_listing():
+    listings = {"review_comments": 0, "comments": 0, "commits": 0}
+
+    class FakePull:
+        def get_review_comments(self):
+            listings["review_comments"] += 1
+            time.sleep(0.05)
+            return []
+
+        def get_commits(self):
+            listings["commits"] += 1
+            time.sleep(0.05)
+            return []
+
+    class FakeIssue:
+        def get_comments(self):
+            listings["comments"] += 1
+            time.sleep(0.05)
+            return []
+
+    class FakeRepo:
+        def get_pull(self, number):
+            return FakePull()
+
+        def get_issue(self, number):
+            return FakeIssue()
+
+    async def lookups():
+        commenter = Commenter(FakeRepo(), AsyncGitHub(FakeRepo(), 8))
+        await asyncio.gather(
+            *[commenter.get_comment_chains_within_range(1, "a.py", 1, 3, "") for _ in range(24)],
+            *[commenter.list_comments(1) for _ in range(8)],
+            *[commenter.get_all_commit_ids(1) for _ in range(8)]
+        )
+
+    asyncio.run(lookups())
+    assert listings == {"review_comments": 1, "comments": 1, "commits": 1}
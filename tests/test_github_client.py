@@ -0,0 +1,124 @@
+import json
+import time
+import base64
+import asyncio
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from github import Github
+from github.Requester import HTTPRequestsConnectionClass
+from app.github_client import AsyncGitHub
+
+# every request to the fake server takes this long, like a round trip to api.github.com
+LATENCY_SECONDS = 0.05
+FILES = 16
+CONCURRENCY = 8
+RACE_REQUESTS = 200
+
+
+class FakeGitHubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency: float):
+        super().__init__(("127.0.0.1", 0), FakeGitHubHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class FakeGitHubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        with self.server.lock:
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+        try:
+            time.sleep(self.server.latency)
+            self.respond()
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+    def respond(self):
+        path = self.path.split("?")[0]
+        if path == "/repos/owner/repo":
+            body = {"full_name": "owner/repo", "name": "repo", "url": f"{self.server.base_url}/repos/owner/repo"}
+        elif path.startswith("/repos/owner/repo/contents/"):
+            name = path[len("/repos/owner/repo/contents/"):]
+            body = {
+                "type": "file", "encoding": "base64", "name": name, "path": name, "sha": "0" * 40, "size": 5,
+                "content": base64.b64encode(f"{name}\n".encode()).decode(),
+                "url": f"{self.server.base_url}{path}",
+            }
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@contextmanager
+def fake_github(latency: float):
+    server = FakeGitHubServer(latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        # without the spacing PyGithub keeps between requests by default, which threads do not share
+        yield server, Github(base_url=server.base_url, seconds_between_requests=0).get_repo("owner/repo")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def get_all_contents(github: AsyncGitHub, filenames):
+    async def fetch_all():
+        return await asyncio.gather(*[github.get_contents(filename, ref="main") for filename in filenames])
+
+    return asyncio.run(fetch_all())
+
+
+def test_contents_are_fetched_concurrently():
+    filenames = [f"file{i}.py" for i in range(FILES)]
+    with fake_github(LATENCY_SECONDS) as (server, repo):
+        server.max_in_flight = 0
+        serial = [repo.get_contents(filename, ref="main") for filename in filenames]
+        serial_in_flight = server.max_in_flight
+
+        server.max_in_flight = 0
+        concurrent = get_all_contents(AsyncGitHub(repo, CONCURRENCY), filenames)
+        concurrent_in_flight = server.max_in_flight
+
+    assert [contents.path for contents in concurrent] == [contents.path for contents in serial] == filenames
+    assert serial_in_flight == 1
+    # the server sees several requests at once instead of one after another
+    assert concurrent_in_flight >= CONCURRENCY // 2
+
+
+def test_concurrent_responses_match_their_requests(monkeypatch):
+    request = HTTPRequestsConnectionClass.request
+
+    # a connection keeps the request until getresponse() sends it; waiting in between lets every other
+    # thread overwrite it if threads share the connection
+    def slow_request(self, *args, **kwargs):
+        request(self, *args, **kwargs)
+        time.sleep(0.005)
+
+    monkeypatch.setattr(HTTPRequestsConnectionClass, "request", slow_request)
+    filenames = [f"file{i}.py" for i in range(RACE_REQUESTS)]
+    with fake_github(0) as (_, repo):
+        contents = get_all_contents(AsyncGitHub(repo, CONCURRENCY), filenames)
+
+    assert [content.path for content in contents] == filenames
+    assert [content.decoded_content.decode() for content in contents] == [f"{name}\n" for name in filenames]